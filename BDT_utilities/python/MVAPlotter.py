@@ -8,7 +8,7 @@ import numpy as np
 import pandas as pd
 from sklearn.metrics import roc_curve, roc_auc_score
 import xgboost as xgb
-import uproot4 as uproot
+from analysis_suite.commons.tables import TableFile, find_table
 import operator
 
 from analysis_suite.commons.plot_utils import plot, color_options
@@ -39,10 +39,9 @@ class MVAPlotter(object):
 
         for year in years:
             trainSamples = set(sum(self.group_dict.values(), []))
-            with uproot.open(workdir / year /  f'{filetype}_{syst}.root') as f:
-                allSet = set([name[:name.index(";")] for name in f.keys()])
-                self.data[year] = {sample.strip(";1"): data.arrays(library="pd")
-                                   for sample, data in f.items()}
+            with TableFile(find_table(workdir / year / f'{filetype}_{syst}', kwargs.get("format", "root"))) as f:
+                allSet = set(f.keys())
+                self.data[year] = {sample: f.arrays(sample) for sample in allSet}
 
         colors = ['#f15854', '#5da5da', '#60bd68', '#faa43a', ]
         #  ['#CC0000', '#99FF00', '#FFCC00', '#3333FF']
@@ -11,13 +11,40 @@ pd.options.mode.chained_assignment = None
 from pandas.api.types import is_numeric_dtype
 from pathlib import Path
 from random import randint
-import uproot4 as uproot
-import uproot as upwrite
 import operator
+import zlib
 from analysis_suite.commons.configs import setup_pandas
+from analysis_suite.commons.files import atomic_write
+from analysis_suite.commons.tables import TableFile, TableWriter, find_table, table_path
+from analysis_suite.Variable_Creator.dedup import mix64
 
 from sklearn.metrics import roc_auc_score, confusion_matrix
-from sklearn.model_selection import train_test_split
+
+def event_fraction(event_id, salt):
+    """Number in [0, 1) for each event, hashed from its id and `salt`,
+    so the same for an event in every systematic and every run"""
+    mixed = mix64(np.asarray(event_id, dtype=np.int64).view(np.uint64) ^ np.uint64(salt))
+    return (mixed >> np.uint64(11)).astype(np.float64)*2.**-53
+
+def split_events(event_id, train_size, salt):
+    """**Split events into (test, train) indices from their ids**
+
+    An event is in train if its `event_fraction` is below the train
+    fraction, so it lands in the same set whatever its row, ie in a
+    systematic with a different selection. The size of train is the
+    asked for one up to statistical fluctuations.
+
+    Args:
+      event_id(numpy.ndarray): Ids of the events (see `dedup.event_ids`)
+      train_size(float or int): Fraction, or number, of events in train
+      salt(int): Seed of the split
+
+    Returns:
+      tuple: sorted test and train indices
+    """
+    fraction = train_size/len(event_id) if isinstance(train_size, int) else train_size
+    train = event_fraction(event_id, salt) < fraction
+    return np.flatnonzero(~train), np.flatnonzero(train)
 
 class MLHolder:
     """Wrapper for XGBoost training. Takes an uproot input, a list of
@@ -30,8 +57,13 @@ class MLHolder:
       group_names(list): List of the names of the different groups
       pred_train(dict): Dictionary of group name to BDT associated with it for train set
       pred_test(dict): Dictionary of group name to BDT associated with it for test set
+      tables(dict): Year to DataFrame of all the events of the year
+      sets(dict): Year to the indices in its table of the train,
+        validation and test events
+      weights(dict): Year to the scale_factor and train_weight of each
+        row of its table, scaled for the set the row is in
       train_set(pandas.DataFrame): DataFrame of the training events
-      test_set(pandas.DataFrame): DataFrame of the testing events
+      test_sets(dict): Year to DataFrame of the testing events
       cuts(list): List of ROOT style cuts to apply
       param(dict): Variables used in the training
 
@@ -43,13 +75,17 @@ class MLHolder:
         self.group_dict = groupDict
         self.sample_map = dict()
         self.systName = systName
+        self.out_format = kwargs.get("out_format", "root")
 
         self.use_vars = use_vars
-        nonTrain_vars = ["scale_factor"]
+        nonTrain_vars = ["scale_factor", "event_id"]
         derived_vars = ["classID", "sampleName", "train_weight"]
         self._file_vars = list(use_vars.keys()) + nonTrain_vars
         self._drop_vars = nonTrain_vars + derived_vars
         self.all_vars = self._file_vars + derived_vars
+        self.types = {"scale_factor": np.float32, "event_id": np.int64, "classID": np.int8,
+                      "sampleName": np.int16, "train_weight": np.float32}
+        self.types.update({key: var.getType() for key, var in use_vars.items()})
 
         self.split_ratio = 0.3
         self.validation_ratio = 0.10
@@ -57,8 +93,11 @@ class MLHolder:
         self.min_train_events = 100
         self.random_state = 12345#randint(0, 2**32-1)#12345
 
-        self.train_set = setup_pandas(self.use_vars, self.all_vars)
-        self.validation_set = setup_pandas(self.use_vars, self.all_vars)
+        self.tables = dict()
+        self.sets = dict()
+        self.weights = dict()
+        self._train_set = None
+        self._validation_set = None
         self.test_sets = dict()
 
         self.pred_test = dict()
@@ -77,17 +116,37 @@ class MLHolder:
 
         This grabs all the variable information about each sample,
         does some preliminary weighting and splits the data into the
-        test and train set (based on `self.split_ratio`)
+        test and train set (based on `self.split_ratio`).
+
+        The samples are concatenated once into a table for the year
+        (`self.tables`), the train, validation and test sets are indices
+        into it (`self.sets`). The weights of the events of each set are
+        scaled up by the fraction of the sample they hold, and kept
+        apart from the table (`self.weights`) so it is never copied
+        until a set is needed as a DataFrame.
+
+        Events are split on their `event_id`, hashed with a seed from
+        `self.random_state` and the sample name (see `split_events`).
+        The train and validation events of Nominal are stored in
+        `directory/year/split.npz`, and every other systematic puts its
+        events in the set they have there (events not in Nominal go in
+        test), so no event Nominal was trained on is ever tested on.
 
         Args:
             directory(string): Path to directory where root files are kept
         """
-        train_set= setup_pandas(self.use_vars, self.all_vars)
-        test_set= setup_pandas(self.use_vars, self.all_vars)
-        validation_set= setup_pandas(self.use_vars, self.all_vars)
-
-        with uproot.open(directory / year / f'processed_{self.systName}.root') as f:
-            allSet = set([name[:name.index(";")] for name in f.keys()])
+        frames = list()
+        scales = list()
+        pieces = {"train": list(), "validation": list(), "test": list()}
+        nrows = 0
+        stored, new_split = None, dict()
+        if self.systName != "Nominal":
+            stored = self.load_split(directory, year)
+            if stored is None:
+                print(f"No Nominal split for {year}, splitting {self.systName} on its own")
+
+        with TableFile(find_table(directory / year / f'processed_{self.systName}', self.out_format)) as f:
+            allSet = set(f.keys())
             self.update_sample_map(allSet)
 
             for className, samples in self.group_dict.items():
@@ -95,57 +154,150 @@ class MLHolder:
                     if sample not in f:
                         print(f"{sample} not found")
                         continue
-                    df = f[sample].arrays(self._file_vars, library="pd")
-                    df.loc[:, "classID"] = self.classID_by_className[className]
-                    df.loc[:, "sampleName"] = self.sample_map[sample]
-                    df.loc[:, "train_weight"] = sum(df.scale_factor) / len(df)
-
-                    split_ratio = self.split_ratio
-                    if len(df) < self.min_train_events/split_ratio or className == "NotTrained":
-                        test_set = pd.concat([df, test_set], ignore_index=True)
-                        continue
-                    elif len(df) > self.max_train_events/split_ratio:
-                        split_ratio = self.max_train_events
-
-                    test, train = self.split(df, split_ratio)
-                    train, validation = self.split(train, self.validation_ratio)
-
-                    train_set = pd.concat([train, train_set], ignore_index=True)
-                    test_set = pd.concat([test, test_set], ignore_index=True)
-                    validation_set = pd.concat([validation, validation_set], ignore_index=True)
-
+                    df = f.arrays(sample, self._file_vars)
+                    df["classID"] = self.classID_by_className[className]
+                    df["sampleName"] = self.sample_map[sample]
+                    df["train_weight"] = sum(df.scale_factor) / len(df)
+                    frames.append(df.astype(self.types, copy=False))
+                    scale = np.ones(len(df))
+                    scales.append(scale)
+                    offset, nrows = nrows, nrows + len(df)
+
+                    event_id = df.event_id.to_numpy()
+                    test, train, validation = self._split(sample, className, event_id, stored)
+                    if stored is None and len(train):
+                        new_split[sample] = {"train": event_id[train],
+                                             "validation": event_id[validation]}
+                    for name, idx in zip(["train", "validation", "test"], [train, validation, test]):
+                        if len(idx):
+                            scale[idx] = len(df)/len(idx)
+                        pieces[name].append(idx + offset)
+
+        if self.systName == "Nominal":
+            self.save_split(directory, year, new_split)
+
+        if frames:
+            table = pd.concat(frames, ignore_index=True)
+            del frames
+            scale = np.concatenate(scales)
+        else:
+            table = setup_pandas(self.use_vars, self.all_vars, self.types)
+            scale = np.ones(0)
+        # newest sample first, the order the sets always had
+        self.sets[year] = {name: np.concatenate(idx[::-1]) if idx else np.zeros(0, dtype=np.int64)
+                           for name, idx in pieces.items()}
+        self.tables[year] = table
+        self.weights[year] = {col: table[col].to_numpy(dtype=np.float64)*scale
+                              for col in ["scale_factor", "train_weight"]}
+        self._train_set = self._validation_set = None
 
         if save_train:
-            self._output(train_set, directory / year / f"train_{self.systName}.root")
-            self._output(validation_set, directory / year / f"validation_{self.systName}.root")
-
-        self.train_set = pd.concat([self.class_reweight(train_set),
-                                    self.train_set], ignore_index=True)
-        self.validation_set = pd.concat([validation_set, self.validation_set],
-                                        ignore_index=True)
-        self.test_sets[year] = test_set
-
-
-    def split(self, workset, split_ratio):
-        train, test = train_test_split(workset, train_size=split_ratio, random_state=self.random_state)
-        test.loc[:, ["scale_factor", "train_weight"]] *= len(workset)/len(test)
-        train.loc[:, ["scale_factor", "train_weight"]] *= len(workset)/len(train)
-        return test, train
+            self._output(self._take(year, "train"), table_path(directory / year / f"train_{self.systName}", self.out_format))
+            self._output(self._take(year, "validation"), table_path(directory / year / f"validation_{self.systName}", self.out_format))
+
+        self.class_reweight(year)
+        self.test_sets[year] = self._take(year, "test")
+
+    @property
+    def train_set(self):
+        """Training events of every year (newest first), built on first use"""
+        if self._train_set is None:
+            self._train_set = self._gather("train")
+        return self._train_set
+
+    @property
+    def validation_set(self):
+        """Validation events of every year (newest first), built on first use"""
+        if self._validation_set is None:
+            self._validation_set = self._gather("validation")
+        return self._validation_set
+
+    def _take(self, year, name):
+        """DataFrame of one set of a year, with its weights"""
+        idx = self.sets[year][name]
+        df = self.tables[year].take(idx).reset_index(drop=True)
+        for col, weight in self.weights[year].items():
+            df[col] = weight[idx].astype(self.types[col])
+        return df
+
+    def _gather(self, name):
+        frames = [self._take(year, name) for year in reversed(self.tables)]
+        if not frames:
+            return setup_pandas(self.use_vars, self.all_vars, self.types)
+        return pd.concat(frames, ignore_index=True)
+
+    def sample_seed(self, sample):
+        """Seed of the splits of a sample, the same in every process"""
+        return np.random.SeedSequence([self.random_state, zlib.crc32(sample.encode())])
+
+    def _split(self, sample, className, event_id, stored=None):
+        """**Test, train and validation indices of the events of a sample**
+
+        With `stored` (see `load_split`) each event goes in the set it
+        has there, in test if it is not there. Otherwise the events are
+        split on their ids, small and untrained samples going all in test.
+        """
+        if stored is not None:
+            sets = stored.get(sample, dict())
+            train = np.isin(event_id, sets.get("train", []))
+            validation = np.isin(event_id, sets.get("validation", []))
+            return np.flatnonzero(~(train | validation)), np.flatnonzero(train), np.flatnonzero(validation)
+
+        nothing = np.zeros(0, dtype=np.int64)
+        split_ratio = self.split_ratio
+        if len(event_id) < self.min_train_events/split_ratio or className == "NotTrained":
+            return np.arange(len(event_id)), nothing, nothing
+        elif len(event_id) > self.max_train_events/split_ratio:
+            split_ratio = self.max_train_events
+
+        test_salt, validation_salt = self.sample_seed(sample).generate_state(2, np.uint64)
+        test, train = split_events(event_id, split_ratio, test_salt)
+        train_idx, validation_idx = split_events(event_id[train], self.validation_ratio,
+                                                 validation_salt)
+        return test, train[train_idx], train[validation_idx]
+
+    def split_path(self, directory, year):
+        return Path(directory) / year / "split.npz"
+
+    def save_split(self, directory, year, split):
+        """Write the sorted train and validation event ids of each sample"""
+        path = self.split_path(directory, year)
+        arrays = {f'{sample}/{name}': np.sort(ids)
+                  for sample, sets in split.items() for name, ids in sets.items()}
+        # other systematics may be reading it
+        with atomic_write(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    def load_split(self, directory, year):
+        """**Train and validation event ids of each sample of Nominal**
+
+        Returns:
+          dict: sample to set name to event ids, None if not stored yet
+        """
+        path = self.split_path(directory, year)
+        if not path.exists():
+            return None
+        split = dict()
+        with np.load(path) as f:
+            for key in f.files:
+                sample, name = key.rsplit("/", 1)
+                split.setdefault(sample, dict())[name] = f[key]
+        return split
 
 
     def update_sample_map(self, allSet):
         for sample in (allSet - set(self.sample_map)):
             self.sample_map[sample] = len(self.sample_map)
 
-    def class_reweight(self, workset):
-        for className, classID in self.classID_by_className.items():
-            class_mask = workset["classID"] == classID
-            class_set = workset[class_mask]
-            if not len(class_set):
-                continue
-            scale = len(class_set)/sum(class_set.train_weight)
-            workset.loc[class_mask, "train_weight"] *= scale
-        return workset
+    def class_reweight(self, year):
+        """Scale the train_weight of the training events of each class
+        so they average to 1"""
+        train = self.sets[year]["train"]
+        weight = self.weights[year]["train_weight"]
+        classes = self.tables[year]["classID"].to_numpy()[train]
+        for classID in np.unique(classes):
+            rows = train[classes == classID]
+            weight[rows] *= len(rows)/weight[rows].sum()
 
 
     def apply_model(self, directory, year):
@@ -228,7 +380,7 @@ class MLHolder:
         workSet = self.test_sets[year]
         for key, arr in self.pred_test[year].items():
             workSet.insert(0, key, arr)
-            self._output(workSet, outdir / year / f"test_{self.systName}.root")
+            self._output(workSet, table_path(outdir / year / f"test_{self.systName}", self.out_format))
 
 
     def _output(self, workSet, outfile):
@@ -240,12 +392,9 @@ class MLHolder:
         """
         keepList = [key for key in workSet.columns if is_numeric_dtype(workSet[key])]
         branches = {key: workSet[key].dtype for key in keepList}
-        with upwrite.recreate(f'{outfile}.tmp') as f:
+        # atomic to avoid losing file if writing fails
+        with TableWriter(outfile, branches, atomic=True) as f:
             for sample, value in self.sample_map.items():
                 if value not in np.unique(workSet.sampleName):
                     continue
-                f[sample] = upwrite.newtree(branches)
-                f[sample].extend(workSet[workSet.sampleName == value][keepList].to_dict('list'))
-
-        # rename to avoid losing file if root writing fails
-        Path(f'{outfile}.tmp').rename(outfile)
+                f.write(sample, workSet[workSet.sampleName == value])
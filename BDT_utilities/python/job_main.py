@@ -2,24 +2,46 @@
 import logging
 import numpy as np
 import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from importlib import import_module
+from itertools import repeat
 
 from analysis_suite.commons import GroupInfo, PlotInfo
 from analysis_suite.commons.configs import getGroupDict, get_list_systs
+from analysis_suite.commons.scheduler import _init_worker
+from analysis_suite.commons.tables import find_table, table_path, table_size
+from analysis_suite.commons.telemetry import add_child, measured
 
 import analysis_suite.data.inputs as mva_params
 
+# Group map, trainer and scoring processes, sent once to each worker (see Scheduler)
+shared = dict()
+
+def preload():
+    """Import the trainer (xgboost, keras...) once per worker"""
+    if "trainType" in shared:
+        get_mva_runner(shared["trainType"])
+
 def setup(cli_args):
     group_info = GroupInfo(**vars(cli_args))
-    groupDict = getGroupDict(mva_params.groups, group_info)
+    shared.update(groupDict=getGroupDict(mva_params.groups, group_info),
+                  trainType=cli_args.train, score_jobs=cli_args.j)
 
     os.environ["NUMEXPR_MAX_THREADS"] = "8"
 
     argList = list()
-
-    for syst in get_list_systs(**vars(cli_args)):
-        argList.append((groupDict, cli_args.workdir, cli_args.train,
-                        cli_args.apply_model, cli_args.years, syst, cli_args.save))
+    allSysts = get_list_systs(**vars(cli_args))
+    if cli_args.train_once:
+        # one task: train on Nominal, then score the rest (see run_train_once)
+        systs = sorted(set(allSysts) | {"Nominal"})
+        return [(cli_args.workdir, cli_args.train, cli_args.apply_model, cli_args.years,
+                 systs, cli_args.save, cli_args.format)]
+
+    for syst in allSysts:
+        argList.append((cli_args.workdir, cli_args.train,
+                        cli_args.apply_model, cli_args.years, syst, cli_args.save,
+                        cli_args.format))
 
     return argList
 
@@ -37,8 +59,11 @@ def get_mva_runner(trainType):
     else:
         return lambda *args, **kwargs : None
 
-def run(groupDict, workdir, trainType, applyModel, years, systName, save_train):
-    mvaRunner = get_mva_runner(trainType)(mva_params.usevars, groupDict, systName=systName)
+def run(workdir, trainType, applyModel, years, systName, save_train, out_format):
+    if not isinstance(systName, str):
+        return run_train_once(workdir, trainType, applyModel, years, systName, save_train, out_format)
+    mvaRunner = get_mva_runner(trainType)(mva_params.usevars, shared["groupDict"], systName=systName,
+                                          out_format=out_format)
     if mvaRunner is None:
         return
     elif trainType == "XGB":
@@ -85,6 +110,81 @@ def run(groupDict, workdir, trainType, applyModel, years, systName, save_train):
         logging.info(f"Finished writing out for year {year} and syst {systName}")
 
 
+def run_train_once(workdir, trainType, applyModel, years, systs, save_train, out_format):
+    """**Train on Nominal only, then score the other systematics**
+
+    The other systematics are only read and scored with the model just
+    trained, in `shared["score_jobs"]` processes (one when already in a
+    pool worker, ie in a pipeline). Their events are put in the sets
+    Nominal stored (see `MLHolder.setup_year`), so the events the model
+    was trained on are never in their test files. Nominal is always
+    run first, before any of them, whatever the order of `systs`.
+    """
+    run(workdir, trainType, applyModel, years, "Nominal", save_train, out_format)
+    others = [syst for syst in systs if syst != "Nominal"]
+    nprocs = min(shared.get("score_jobs", 1), len(others))
+    if nprocs > 1 and mp.current_process().daemon:
+        logging.warning("Cannot start a process pool inside a pool worker, scoring serially")
+        nprocs = 1
+    if nprocs <= 1:
+        for syst in others:
+            score(workdir, trainType, years, syst, out_format)
+        return
+    with ProcessPoolExecutor(nprocs, initializer=_init_worker,
+                             initargs=(__name__, dict(shared))) as pool:
+        for _, stats in pool.map(measured, repeat(score), repeat(workdir), repeat(trainType),
+                                 repeat(years), others, repeat(out_format)):
+            add_child(stats)
+
+
+def score(workdir, trainType, years, systName, out_format):
+    """Apply the trained model to one systematic, writing its test file"""
+    mvaRunner = get_mva_runner(trainType)(mva_params.usevars, shared["groupDict"], systName=systName,
+                                          out_format=out_format)
+    if mvaRunner is None:
+        return
+    mvaRunner.add_cut(mva_params.cuts)
+    print(f"Scoring syst {systName}")
+
+    for year in years:
+        if not mvaRunner.split_path(workdir, year).exists():
+            raise FileNotFoundError(f'No Nominal split for year {year}, the model has to be trained '
+                                    'on Nominal first')
+        mvaRunner.setup_year(workdir, year)
+    for year in years:
+        mvaRunner.apply_model(workdir, year)
+        if year == "2016":
+            mvaRunner.output(workdir, year)
+
+
+def _systs(systName):
+    return [systName] if isinstance(systName, str) else systName
+
+
+def task_cost(workdir, trainType, applyModel, years, systName, save_train, out_format):
+    """Bytes of the processed files read"""
+    return sum(table_size(find_table(workdir / year / f'processed_{syst}', out_format))
+               for year in years for syst in _systs(systName))
+
+
+def task_inputs(workdir, trainType, applyModel, years, systName, save_train, out_format):
+    inputs = [find_table(workdir / year / f'processed_{syst}', out_format)
+              for year in years for syst in _systs(systName)]
+    if "Nominal" not in _systs(systName):
+        # the split stored by Nominal, so the pipeline runs Nominal first
+        inputs += [workdir / year / "split.npz" for year in years]
+    return inputs
+
+
+def task_outputs(workdir, trainType, applyModel, years, systName, save_train, out_format):
+    # only the 2016 test set is written (see run), Nominal also stores its split
+    outputs = [table_path(workdir / year / f"test_{syst}", out_format)
+               for year in years if year == "2016" for syst in _systs(systName)]
+    if "Nominal" in _systs(systName):
+        outputs += [workdir / year / "split.npz" for year in years]
+    return outputs
+
+
 def cleanup(cli_args):
     if not cli_args.plot:
         return
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import uproot4 as uproot
+from analysis_suite.commons.tables import TableFile
 from analysis_suite.commons.histogram import Histogram
 import boost_histogram as bh
 import numpy as np
@@ -18,17 +18,17 @@ def getNormedHistos(infilename, file_info, plot_info, histName, year):
 
     binning = get_binning(size, start, end, len(cr_list))
 
-    with uproot.open(infilename) as f:
+    with TableFile(infilename) as f:
         for group, members in file_info.group2MemberMap.items():
             groupHists[group] = Histogram(group, binning)
             for mem in members:
                 if mem not in f:
                     logging.warning(f'Could not find sample {mem} in file for year {year}')
                     continue
-                if ak_col not in f[mem]:
+                if ak_col not in f.columns(mem):
                     logging.error(f"Could not find variable {histName} in file for year {year}")
                     raise ValueError()
-                arrays = f[mem].arrays()
+                arrays = f.arrays(mem)
 
                 groupHists[group].fill(*create_SR(arrays, "NBJets"))
                 for cr_bin, cr_func in zip(cr_bins, cr_list):
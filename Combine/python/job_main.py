@@ -6,6 +6,7 @@ import numpy as np
 
 from analysis_suite.commons import GroupInfo, PlotInfo
 from analysis_suite.commons.configs import getGroupDict, get_list_systs, checkOrCreateDir, clean_syst
+from analysis_suite.commons.tables import find_table, table_size
 from .histogram_creater import getNormedHistos
 
 from .card_maker import Card_Maker
@@ -13,9 +14,13 @@ from .hist_writer import from_boost
 
 import analysis_suite.data.inputs as mva_params
 
+# GroupInfo and PlotInfo, sent once to each worker (see Scheduler)
+shared = dict()
+
 def setup(cli_args):
     group_info = GroupInfo(mva_params.color_by_group, **vars(cli_args))
     plot_info = PlotInfo(cli_args.info)
+    shared.update(group_info=group_info, plot_info=plot_info)
     allSysts = get_list_systs(**vars(cli_args))
 
     workdir = cli_args.workdir / "combine"
@@ -25,14 +30,15 @@ def setup(cli_args):
     for year in cli_args.years:
         inpath = cli_args.workdir/year
 
-        argList.append((inpath, workdir, group_info, plot_info, cli_args.fit_var, year, allSysts))
+        argList.append((inpath, workdir, cli_args.fit_var, year, allSysts, cli_args.format))
 
     return argList
 
-def run(inpath, outpath, file_info, plot_info, histName, year, systs):
+def run(inpath, outpath, histName, year, systs, in_format):
+    file_info, plot_info = shared["group_info"], shared["plot_info"]
     with upwrite.recreate(outpath / f'{histName}_yr{year}.root') as f:
         for syst in systs:
-            groupHists = getNormedHistos(inpath/f"test_{syst}.root", file_info,
+            groupHists = getNormedHistos(find_table(inpath/f"test_{syst}", in_format), file_info,
                                          plot_info, histName, year)
             syst = syst.replace("_up", "Up").replace("_down", "Down")
             if syst == "Nominal":
@@ -41,6 +47,19 @@ def run(inpath, outpath, file_info, plot_info, histName, year, systs):
                 f[f"{group}_{syst}"] = from_boost(hist.hist, histName)
 
 
+def task_cost(inpath, outpath, histName, year, systs, in_format):
+    """Bytes of the test files read"""
+    return sum(table_size(find_table(inpath/f"test_{syst}", in_format)) for syst in systs)
+
+
+def task_inputs(inpath, outpath, histName, year, systs, in_format):
+    return [find_table(inpath/f"test_{syst}", in_format) for syst in systs]
+
+
+def task_outputs(inpath, outpath, histName, year, systs, in_format):
+    return [outpath / f'{histName}_yr{year}.root']
+
+
 def cleanup(cli_args):
     group_info = GroupInfo(mva_params.color_by_group, **vars(cli_args))
     shapeSysts = {clean_syst(syst) for syst in get_list_systs(**vars(cli_args))}
@@ -13,11 +13,21 @@ from analysis_suite.commons.plot_utils import plot, setup_mplhep, setup_ticks, a
 import analysis_suite.commons.configs as config
 from analysis_suite.commons import writeHTML, PlotInfo, GroupInfo
 from analysis_suite.commons.histogram import Histogram
+from analysis_suite.commons.tables import find_table, table_size
 import analysis_suite.data.inputs as plot_params
 from .stack import Stack
 from .LogFile import LogFile
 
-hep = setup_mplhep()
+hep = None
+# PlotInfo and GroupInfo, sent once to each worker (see Scheduler)
+shared = dict()
+
+def preload():
+    """Set up matplotlib/mplhep once per process rather than in the first plot of each worker"""
+    global hep
+    if hep is None:
+        import boost_histogram
+        hep = setup_mplhep()
 
 def setup(cli_args):
     callTime = str(datetime.datetime.now())
@@ -31,6 +41,7 @@ def setup(cli_args):
 
     plot_info = PlotInfo(cli_args.info)
     group_info = GroupInfo(plot_params.color_by_group, **vars(cli_args))
+    shared.update(plot_info=plot_info, group_info=group_info)
     basePath = config.get_plot_area(cli_args.analysis, cli_args.drawStyle,
                                     cli_args.workdir)
     config.make_plot_paths(basePath)
@@ -42,24 +53,25 @@ def setup(cli_args):
         baseYear = basePath / year
         config.make_plot_paths(baseYear)
         for syst in allSysts:
-            filename = path / f'test_{syst}.root'
+            filename = find_table(path / f'test_{syst}', cli_args.format)
             outpath = baseYear
             if syst != "Nominal":
                 outpath = outpath / syst
                 config.make_plot_paths(outpath)
             for histName in plot_info.get_hists(cli_args.hists):
-                argList.append((histName, group_info, plot_info, outpath,
-                                filename, cli_args.signal, year, syst))
+                argList.append((histName, outpath, filename, cli_args.signal, year, syst))
 
     # for histName in plot_info.get_hists(cli_args.hists):
-    #     argList.append((histName, group_info, plot_info, basePath,
+    #     argList.append((histName, basePath,
     #                     cli_args.workdir / "test_Nominal.root",
     #                     cli_args.signal, "all", "Nominal"))
 
     return argList
 
 
-def run(histName, file_info, plot_info, outpath, filename, signalName, year, syst):
+def run(histName, outpath, filename, signalName, year, syst):
+    preload()
+    file_info, plot_info = shared["group_info"], shared["plot_info"]
     logging.info(f'Processing {histName} for year {year} and systematic {syst}')
 
     logger = LogFile(histName, plot_info.at(histName), plot_info.get_lumi(year))
@@ -136,6 +148,20 @@ def run(histName, file_info, plot_info, outpath, filename, signalName, year, sys
 
 
 
+def task_cost(histName, outpath, filename, signalName, year, syst):
+    """Bytes of the test file read"""
+    return table_size(filename)
+
+
+def task_inputs(histName, outpath, filename, signalName, year, syst):
+    return [filename]
+
+
+def task_outputs(histName, outpath, filename, signalName, year, syst):
+    plotBase = outpath / 'plots' / histName
+    return [Path(f'{plotBase}.png'), Path(f'{plotBase}.pdf')]
+
+
 def cleanup(cli_args):
     basePath = config.get_plot_area(cli_args.analysis, cli_args.drawStyle,
                                     cli_args.workdir)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+.. module:: cache
+   :synopsis: Content addressed cache of the columns made by Variable_Creator
+"""
+import json
+import hashlib
+import inspect
+import numpy as np
+from pathlib import Path
+
+from analysis_suite.commons.files import atomic_write, file_sha1
+from . import vargetter, graph, kernels, dedup, data_processor
+
+def _sha1(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(str(part).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class ColumnCache:
+    """**Columns of processed files, stored per input file, group and systematic**
+
+    Each column is keyed by the input file (its mtime and size, or its
+    content hash), the tree, the group and systematic, and a hash of the
+    Variable definition (or column name for the scale and event keys),
+    output dtype and the VarGetter/kernel/DataProcessor code. A changed
+    Variable or input file only invalidates its own columns, a change in
+    the code all of them, so the columns of a file always hold the same
+    events.
+    Stale entries are never read again, delete the cache directory to
+    reclaim the space.
+
+    Layout: `<directory>/<file key>/<tree>/index.json` holds the
+    systematics and sumweight of each group of the file, and
+    `<directory>/<file key>/<tree>/<group>/<syst>/<column key>.npy` the
+    columns.
+
+    Args:
+      directory(Path): Cache directory
+      hash_content(bool): Key input files by content hash instead of mtime
+    """
+    def __init__(self, directory, hash_content=False):
+        self.directory = Path(directory)
+        self.hash_content = hash_content
+        modules = (vargetter, graph, kernels, dedup, data_processor)
+        self._code = _sha1(*[inspect.getsource(mod) for mod in modules], kernels.backend)
+
+    def file_key(self, path):
+        path = Path(path)
+        if not self.hash_content:
+            stat = path.stat()
+            return _sha1(path.resolve(), stat.st_size, stat.st_mtime_ns)
+        return file_sha1(path)
+
+    def var_key(self, var, dtype):
+        return _sha1(self._code, var.func.__qualname__, var.inputs, np.dtype(dtype).str)
+
+    def column_key(self, name, dtype):
+        """Key of a column not made by a Variable, ie the scale"""
+        return _sha1(self._code, name, np.dtype(dtype).str)
+
+    def read_index(self, file_key, tree):
+        path = self.directory / file_key / tree / "index.json"
+        if not path.exists():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_index(self, file_key, tree, index):
+        path = self.directory / file_key / tree / "index.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump(index, f)
+
+    def _column(self, file_key, tree, group, syst, key):
+        return self.directory / file_key / tree / group / syst / f'{key}.npy'
+
+    def has(self, file_key, tree, group, syst, key):
+        return self._column(file_key, tree, group, syst, key).exists()
+
+    def load(self, file_key, tree, group, syst, key):
+        return np.load(self._column(file_key, tree, group, syst, key))
+
+    def save(self, file_key, tree, group, syst, key, values):
+        path = self._column(file_key, tree, group, syst, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path, "wb") as f:
+            np.save(f, np.asarray(values))
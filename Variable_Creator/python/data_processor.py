@@ -1,77 +1,415 @@
 #!/usr/bin/env python3
-from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import logging
 from .vargetter import VarGetter
+from .graph import VarGraph
+from .dedup import EventIndex, key_type, event_ids
 import awkward1 as ak
 from pathlib import Path
+from contextlib import ExitStack
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
 import uproot4
-import uproot as upwrite
+from . import kernels
+from analysis_suite.commons.tables import TableWriter, table_path
+from analysis_suite.commons.metadata import load_metadata
+from analysis_suite.commons.telemetry import add_events, add_child, measured
 
 class DataProcessor:
-    def __init__(self, use_vars, systName="Nominal"):
+    def __init__(self, use_vars, systName="Nominal", out_format="root"):
         """Constructor method
+
+        Args:
+          use_vars(dict): Variable name to Variable used to fill it
+          systName(str or list): Systematic(s) to process. With a list, each
+            group is read once and every systematic is written in one pass
         """
-        self.systName = systName
+        self.systNames = [systName] if isinstance(systName, str) else list(systName)
         self.use_vars = use_vars
-        self.all_vars = list(use_vars.keys()) + ["scale_factor"]
+        # event_id finds an event again in every systematic (see dedup.event_ids)
+        self.all_vars = list(use_vars.keys()) + ["scale_factor", "event_id"]
+        self.branch_types = {key: var.getType() for key, var in use_vars.items()}
+        self.branch_types["scale_factor"] = np.dtype(np.float32)
+        self.branch_types["event_id"] = np.dtype(np.int64)
+        self.out_format = out_format
+        self.syst_index = dict()
+        self.var_branches = VarGetter.required_branches(use_vars, self.systNames)
+        self.branches = set().union(*self.var_branches.values())
+        self.depths = dict()
+        for var in use_vars.values():
+            for part, depth in var.depths().items():
+                self.depths[part] = max(self.depths.get(part, 1), depth)
+        self.graph = VarGraph(use_vars)
+        self._graphs = {tuple(use_vars): self.graph}
+        self.profiler = None
+        logging.debug(f'Evaluation plan:\n{self.graph}')
+
+    def get_final_dict(self, directory, tree, workers=1):
+        """**Variables of every group and systematic in the input**
+
+        Each input file is processed on its own, in `workers` processes,
+        giving unnormalised columns and the sumweight of each group. The
+        files are then concatenated in order and the scale divided by the
+        sumweight summed over all files.
+
+        Returns:
+          dict: systematic to group to DataFrame
+        """
+        root_files = self._root_files(directory)
+        pieces = self._map_files("file_columns", root_files, workers, tree)
+        sumw = dict()
+        for systs, file_sumw, _ in pieces:
+            self.set_syst_index(systs)
+            for group, group_sumw in file_sumw.items():
+                sumw[group] = sumw.get(group, 0) + group_sumw
+
+        final_dict = dict()
+        for systName in self.systNames:
+            final_dict[systName] = dict()
+            for group in sumw:
+                columns = [(root_file.stem, file_columns[systName][group])
+                           for root_file, (_, file_sumw, file_columns) in zip(root_files, pieces)
+                           if group in file_sumw]
+                df = self._merge(columns, sumw[group], group, systName)
+                if df is not None:
+                    final_dict[systName][group] = df
+        return final_dict
+
+    def file_columns(self, root_file, tree):
+        """**Variables of one input file, with the scale not yet normalised**
+
+        Returns:
+          tuple: systematic names of the file, sumweight per group and
+            systematic to group to dict of columns
+        """
+        meta = load_metadata(root_file)
+        systs = meta.systematics
+        self.set_syst_index(systs)
+        sumw, columns = dict(), dict()
+        with uproot4.open(root_file) as f:
+            for group in self._groups(meta, tree):
+                # duplicates are removed across files when merging
+                arr = VarGetter(f, tree, group, list(self.syst_index.values()), self.branches,
+                                dedup=False, meta=meta[group])
+                if self.profiler is not None:
+                    self.profiler.record_read(group, arr.read_time, arr.entries)
+                sumw[group] = arr.sumw
+                arr.sumw = 1.
+                for systName in self.systNames:
+                    arr.set_syst(self.syst_index[systName], systName)
+                    columns.setdefault(systName, dict())[group] = self._evaluate(
+                        arr, self._columns(group), systName)
+        return systs, sumw, columns
+
+    def _columns(self, group):
+        """Columns made for a group, data also keeps its event keys for deduplication"""
+        return self.all_vars + ["event_keys"] if group == "data" else self.all_vars
+
+    def _merge(self, columns, sumw, group, systName):
+        """**DataFrame of a group from the columns of each file**
+
+        Duplicate data events are removed across all files, keeping the
+        first copy, and the counts are reported per dataset (input file).
+
+        Args:
+          columns(list): (dataset, dict of columns) of each file in order
+          sumw(float): Sumweight of the group summed over the files
+
+        Returns:
+          DataFrame: the variables, None if there are no events
+        """
+        if group == "data":
+            index = EventIndex()
+            deduped = list()
+            for dataset, cols in columns:
+                index.dataset = dataset
+                keep = index.add(cols["event_keys"])
+                deduped.append((dataset, {name: cols[name][keep] for name in self.all_vars}))
+            columns = deduped
+            logging.info(f'Duplicate data events for {systName}:\n{index.report()}')
+
+        df = pd.DataFrame.from_dict({name: np.concatenate([cols[name] for _, cols in columns])
+                                     for name in self.all_vars})
+        if not len(df):
+            logging.warning(f'Sample {group} has no events in it for syst {systName}!')
+            return None
+        df["scale_factor"] /= sumw
+        return df
 
-    def get_final_dict(self, directory, tree):
-        arr_dict = dict()
+    def _map_files(self, method, root_files, workers, *args):
+        """Call `method(root_file, *args)` for each input file, with
+        `workers` processes. The results are in the order of the files"""
+        if workers > 1 and self.profiler is not None:
+            logging.warning("Profiling, processing files serially")
+            workers = 1
+        elif workers > 1 and mp.current_process().daemon:
+            logging.warning("Cannot start a process pool inside a pool worker, "
+                            "processing files serially (use -j 1 with --file_jobs)")
+            workers = 1
+        if workers <= 1 or len(root_files) <= 1:
+            return [getattr(self, method)(root_file, *args) for root_file in root_files]
+        initargs = (self.use_vars, self.systNames, self.out_format, kernels.backend)
+        with ProcessPoolExecutor(min(workers, len(root_files)), initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            results = list(pool.map(_call_worker, repeat(method), root_files,
+                                    *[repeat(arg) for arg in args]))
+        for _, stats in results:
+            add_child(stats)
+        return [result for result, _ in results]
+
+    def _root_files(self, directory):
         path = Path(directory)
-        root_files = path.rglob("*.root") if path.is_dir() else [path]
-        for root_file in root_files:
-            groups = list()
-            syst = 0
-            with uproot4.open(root_file) as f:
-                groups = [key.strip(";1") for key in f.keys() if "/" not in key]
-                systNames = [systName.member("fName") for systName in f[groups[0]]["Systematics"]]
-                systNames = list(OrderedDict.fromkeys(systNames))
-                syst = systNames.index(self.systName)
-                for group in groups:
-                    if tree == "Analyzed" and group == "data":
-                        # blind SR
-                        continue
-                    if group not in arr_dict:
-                        arr_dict[group] = VarGetter(f, tree, group, syst)
-                    else:
-                        arr_dict[group] += VarGetter(f, tree, group, syst)
-        for key, val in arr_dict.items():
-            val.set_JEC(self.systName)
-
-        return arr_dict
-
-    def process_year(self, infile, outdir, tree):
+        return sorted(path.rglob("*.root")) if path.is_dir() else [path]
+
+    def _groups(self, meta, tree):
+        groups = list(meta.groups)
+        if tree == "Analyzed":
+            # blind SR
+            groups = [group for group in groups if not meta[group].isData]
+        return groups
+
+    def set_syst_index(self, systNames):
+        syst_index = {syst: systNames.index(syst) for syst in self.systNames}
+        if self.syst_index and self.syst_index != syst_index:
+            raise ValueError("Input files have different systematic orderings")
+        self.syst_index = syst_index
+
+    def branch_report(self):
+        """Dry run summary of the branches read for each variable"""
+        lines = [f'{len(self.branches)} branches read (plus {", ".join(VarGetter.base_branches)})']
+        width = max(map(len, self.var_branches))
+        for varname, branches in self.var_branches.items():
+            lines.append(f'{varname:{width}} : {", ".join(sorted(branches))}')
+        lines += ["", f'Evaluation plan ({len(self.graph.nodes)} nodes):', str(self.graph)]
+        return "\n".join(lines)
+
+    def process_year(self, infile, outdir, tree, step_size=None, cache=None, workers=1):
+        """**Process the input and write the processed file of each systematic**
+
+        Args:
+          step_size(int or str, optional): Stream the input in chunks of this size
+          cache(ColumnCache, optional): Only compute columns missing from the cache
+          workers(int): Number of processes to spread the input files over
+        """
+        if step_size is not None:
+            return self.process_year_stream(infile, outdir, tree, step_size)
+        elif cache is not None:
+            return self.process_year_cached(infile, outdir, tree, cache, workers)
         # Process input file
-        arr_dict = self.get_final_dict(infile, tree)
-        final_set = dict()
-
-        for sample, arr in arr_dict.items():
-            if not len(arr):
-                logging.warning(f'Sample {sample} has no events in it!')
-                continue
-            df_dict = {varname: func.apply(arr) for varname, func in self.use_vars.items()}
-            df_dict["scale_factor"] = ak.to_numpy(arr.scale)
-            df = pd.DataFrame.from_dict(df_dict)
-            final_set[sample] = df
+        final_dict = self.get_final_dict(infile, tree, workers)
+
+        for systName in self.systNames:
+            self._write_out(self._outfile(outdir, systName, tree), final_dict[systName])
+        self._write_profile(outdir, tree)
 
+    def process_year_stream(self, infile, outdir, tree, step_size):
+        """**Process the input in chunks of `step_size` entries**
+
+        Each chunk is turned into variables and appended to the output
+        trees right away, so at most one chunk per input tree is in
+        memory. The total sumweight of each group is read first so the
+        scale of every chunk is already normalised.
+        """
+        root_files = self._root_files(infile)
+        sumw = dict()
+        for root_file in root_files:
+            meta = load_metadata(root_file)
+            for group in self._groups(meta, tree):
+                sumw[group] = sumw.get(group, 0) + meta[group].sumw
+
+        index = EventIndex()
+        with ExitStack() as stack:
+            outfiles = {syst: stack.enter_context(TableWriter(self._outfile(outdir, syst, tree),
+                                                              self.branch_types))
+                        for syst in self.systNames}
+            written = {syst: set() for syst in self.systNames}
+            for root_file in root_files:
+                meta = load_metadata(root_file)
+                self.set_syst_index(meta.systematics)
+                index.dataset = root_file.stem
+                with uproot4.open(root_file) as f:
+                    for group in self._groups(meta, tree):
+                        for arr in VarGetter.iterate(f, tree, group, list(self.syst_index.values()),
+                                                     self.branches, step_size, dedup=index,
+                                                     meta=meta[group]):
+                            if self.profiler is not None:
+                                self.profiler.record_read(group, arr.read_time, arr.entries)
+                            arr.sumw = sumw[group]
+                            for systName in self.systNames:
+                                arr.set_syst(self.syst_index[systName], systName)
+                                if not len(arr):
+                                    continue
+                                df = self.get_dataframe(arr, systName)
+                                outfiles[systName].write(group, df)
+                                add_events(len(df))
+                                written[systName].add(group)
+
+        if index.counts:
+            logging.info(f'Duplicate data events:\n{index.report()}')
+        self._write_profile(outdir, tree)
+        for systName, groups in written.items():
+            for group in set(sumw) - groups:
+                logging.warning(f'Sample {group} has no events in it for syst {systName}!')
+
+    def process_year_cached(self, infile, outdir, tree, cache, workers=1):
+        """**Process the input, only computing the columns missing from `cache`**
+
+        Columns are made per input file and reused by later runs, so
+        adding a Variable or changing one input file only evaluates the
+        affected columns. The scale is cached before dividing by the
+        sumweight, which is summed over all files of a group here.
+
+        Args:
+          cache(ColumnCache): Cache to read from and fill
+        """
+        keys = {name: cache.var_key(var, self.branch_types[name])
+                for name, var in self.use_vars.items()}
+        for name in ["scale_factor", "event_id", "event_keys"]:
+            keys[name] = cache.column_key(name, self._cache_type(name))
+        root_files = self._root_files(infile)
+        file_keys = self._map_files("_fill_cache", root_files, workers, tree, cache, keys)
+        sumw = dict()
+        for file_key, index in file_keys:
+            self.set_syst_index(index["systs"])
+            for group, group_sumw in index["sumw"].items():
+                sumw[group] = sumw.get(group, 0) + group_sumw
+
+        for systName in self.systNames:
+            final_set = dict()
+            for group in sumw:
+                columns = [(root_file.stem, {name: cache.load(file_key, tree, group, systName, keys[name])
+                                             for name in self._columns(group)})
+                           for root_file, (file_key, index) in zip(root_files, file_keys)
+                           if group in index["sumw"]]
+                df = self._merge(columns, sumw[group], group, systName)
+                if df is not None:
+                    final_set[group] = df
+
+            self._write_out(self._outfile(outdir, systName, tree), final_set)
+
+    def _fill_cache(self, root_file, tree, cache, keys):
+        """**Compute the columns of one input file missing from the cache**
+
+        The file is only opened if something is missing. Events are read
+        once for all systematics, and only the branches the missing
+        columns need.
+
+        Returns:
+          tuple: key of the file and its index (systematics, sumweight per group)
+        """
+        file_key = cache.file_key(root_file)
+        index = cache.read_index(file_key, tree)
+        if index is None:
+            meta = load_metadata(root_file)
+            index = {"systs": meta.systematics,
+                     "sumw": {group: meta[group].sumw for group in self._groups(meta, tree)}}
+            cache.write_index(file_key, tree, index)
+        self.set_syst_index(index["systs"])
+        if not (todo := self._missing(cache, file_key, tree, index, keys)):
+            return file_key, index
+
+        meta = load_metadata(root_file)
+        with uproot4.open(root_file) as f:
+            for group, missing in todo.items():
+                missing_vars = {name: self.use_vars[name] for names in missing.values()
+                                for name in names if name in self.use_vars}
+                branches = VarGetter.required_branches(missing_vars, self.systNames)
+                arr = VarGetter(f, tree, group, list(self.syst_index.values()),
+                                set().union(*branches.values()), dedup=False, meta=meta[group])
+                # normalised to the total sumweight when merging files
+                arr.sumw = 1.
+                for systName, names in missing.items():
+                    arr.set_syst(self.syst_index[systName], systName)
+                    for name, values in self._evaluate(arr, names).items():
+                        cache.save(file_key, tree, group, systName, keys[name], values)
+        return file_key, index
+
+    def _missing(self, cache, file_key, tree, index, keys):
+        """Group to systematic to names of the columns not in the cache"""
+        todo = dict()
+        for group in index["sumw"]:
+            for systName in self.systNames:
+                names = [name for name in self._columns(group)
+                         if not cache.has(file_key, tree, group, systName, keys[name])]
+                if names:
+                    todo.setdefault(group, dict())[systName] = names
+        return todo
+
+    def _evaluate(self, arr, names, systName=None):
+        """Columns `names` for the current systematic, cast to their output type"""
+        if not len(arr):
+            return {name: np.empty(0, dtype=self._cache_type(name)) for name in names}
+        var_names = tuple(name for name in names if name in self.use_vars)
+        arr.depths = self.depths
+        if self.profiler is not None:
+            columns = {name: self.profiler.apply(systName, name, self.use_vars[name], arr)
+                       for name in var_names}
+        else:
+            if var_names not in self._graphs:
+                self._graphs[var_names] = VarGraph({name: self.use_vars[name] for name in var_names})
+            columns = self._graphs[var_names].evaluate(arr)
+        if "scale_factor" in names:
+            columns["scale_factor"] = ak.to_numpy(arr.scale)
+        if "event_keys" in names or "event_id" in names:
+            keys = arr.event_keys()
+            columns.update(event_keys=keys, event_id=event_ids(keys))
+        return {name: np.asarray(columns[name], dtype=self._cache_type(name)) for name in names}
+
+    def _cache_type(self, name):
+        # the scale is divided by the sumweight after reading, keep full precision
+        if name == "scale_factor":
+            return np.float64
+        elif name == "event_keys":
+            return key_type
+        return self.branch_types[name]
+
+    def get_dataframe(self, arr, systName=None):
+        arr.depths = self.depths
+        if self.profiler is not None:
+            df_dict = {name: self.profiler.apply(systName, name, var, arr)
+                       for name, var in self.use_vars.items()}
+        else:
+            df_dict = self.graph.evaluate(arr)
+        df_dict["scale_factor"] = ak.to_numpy(arr.scale)
+        df_dict["event_id"] = arr.event_ids()
+        return pd.DataFrame.from_dict(df_dict)
+
+    def _write_profile(self, outdir, tree):
+        if self.profiler is None:
+            return
+        for systName in self.systNames:
+            self.profiler.write(self._outfile(outdir, systName, tree), systName)
+
+    def _outfile(self, outdir, systName, tree):
         treename = "" if tree == "Analyzed" else f'_{tree}'
-        self._write_out(outdir / f'processed_{self.systName}{treename}.root', final_set)
+        return table_path(outdir / f'processed_{systName}{treename}', self.out_format)
 
     def _write_out(self, outfile, workSet):
-        """**Write out pandas file as a compressed pickle file
+        """**Write out the DataFrames of each group
 
         Args:
           outfile(string): Name of file to write
-          workSet(pandas.DataFrame): DataFrame of variables to write out
-          prediction(pandas.DataFrame): DataFrame of BDT predictions
+          workSet(dict): Group name to DataFrame of variables to write out
 
         """
-        branches = {key: np.int32 if key[0] == "N" else  np.float32 for key in self.all_vars}
-        with upwrite.recreate(outfile) as f:
+        with TableWriter(outfile, self.branch_types) as f:
             for group, df in workSet.items():
                 if not len(df):
                     continue
-                f[group] = upwrite.newtree(branches)
-                f[group].extend(df.to_dict('list'))
+                f.write(group, df)
+                add_events(len(df))
+
+
+# Process pool workers each hold their own DataProcessor
+
+_worker = None
+
+def _init_worker(use_vars, systNames, out_format, backend):
+    global _worker
+    kernels.set_backend(backend)
+    _worker = DataProcessor(use_vars, systNames, out_format)
+
+def _call_worker(method, *args):
+    return measured(getattr(_worker, method), *args)
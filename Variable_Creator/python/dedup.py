@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+.. module:: dedup
+   :synopsis: Keys of events, removal of data events seen in several files or primary datasets
+"""
+import numpy as np
+
+key_type = np.dtype([("runlumi", ">u8"), ("event", ">u8")])
+
+def event_keys(run, lumiBlock, event):
+    """Pack (run, luminosityBlock, event) into one 16 byte sortable key"""
+    keys = np.empty(len(event), dtype=key_type)
+    keys["runlumi"] = (np.asarray(run, dtype=np.uint64) << np.uint64(32)) \
+        | np.asarray(lumiBlock, dtype=np.uint64)
+    keys["event"] = event
+    return keys
+
+def mix64(values):
+    """splitmix64 finalizer: 64 bit hash of each value, spread uniformly"""
+    x = np.asarray(values).astype(np.uint64)
+    # wraps around like the C version, numpy only warns for scalars
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+def event_ids(keys):
+    """**64 bit id of each event from its key (see `event_keys`)**
+
+    The same event gets the same id in every systematic, so it can be
+    found again whatever row it is in (ie to split train and test).
+
+    Returns:
+      numpy.ndarray: int64 ids
+    """
+    return (mix64(mix64(keys["runlumi"]) ^ keys["event"].astype(np.uint64))).view(np.int64)
+
+
+class EventIndex:
+    """**Sorted index of the data events kept so far**
+
+    Feed it the events of each file (or chunk) in order: `add` returns
+    which events have not been seen before, keeping the first copy.
+    Only the 16 byte keys are held, never the events themselves.
+    Events are counted under `dataset`, set it before adding the events
+    of each input file.
+    """
+    def __init__(self):
+        self._seen = np.empty(0, dtype=key_type)
+        self.dataset = None
+        self.counts = dict()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, keys):
+        """**Add events, returning the mask of those not seen before**
+
+        Args:
+          keys(numpy.ndarray): event keys (see `event_keys`)
+        """
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        new = first & ~self._contains(sorted_keys)
+
+        idx = np.searchsorted(self._seen, sorted_keys[new])
+        self._seen = np.insert(self._seen, idx, sorted_keys[new])
+        keep = np.zeros(len(keys), dtype=bool)
+        keep[order[new]] = True
+
+        counts = self.counts.setdefault(self.dataset, [0, 0])
+        counts[0] += len(keys)
+        counts[1] += len(keys) - np.count_nonzero(new)
+        return keep
+
+    def _contains(self, keys):
+        if not len(self._seen):
+            return np.zeros(len(keys), dtype=bool)
+        idx = np.minimum(np.searchsorted(self._seen, keys), len(self._seen)-1)
+        return self._seen[idx] == keys
+
+    def report(self):
+        """Table of events and duplicates removed per dataset"""
+        width = max([len(str(dataset)) for dataset in self.counts] + [7])
+        lines = [f'{"Dataset":{width}} {"Events":>10} {"Duplicates":>10}']
+        for dataset, (total, dups) in self.counts.items():
+            lines.append(f'{dataset!s:{width}} {total:>10} {dups:>10}')
+        return "\n".join(lines)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import operator
+import warnings
+import numpy as np
+
+from .vargetter import VarGetter as vg
+from . import kernels
+
+builders = dict()
+
+def builds(func):
+    """Register how a VarGetter function is split into graph nodes"""
+    def wrapper(builder):
+        builders[func] = builder
+        return builder
+    return wrapper
+
+
+class Node:
+    """Single column operation in a VarGraph. Nodes are interned by the
+    graph, so two nodes are the same object iff they compute the same thing"""
+    def __init__(self, graph, idx, func, args, kwargs, leaf):
+        self.graph = graph
+        self.idx = idx
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.leaf = leaf
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != "__call__":
+            return NotImplemented
+        return self.graph.apply(ufunc, *inputs, **kwargs)
+
+    def __array_function__(self, func, types, args, kwargs):
+        return self.graph.apply(func, *args, **kwargs)
+
+    def __add__(self, other):
+        return self.graph.apply(operator.add, self, other)
+
+    def __radd__(self, other):
+        return self.graph.apply(operator.add, other, self)
+
+    def __sub__(self, other):
+        return self.graph.apply(operator.sub, self, other)
+
+    def __rsub__(self, other):
+        return self.graph.apply(operator.sub, other, self)
+
+    def __mul__(self, other):
+        return self.graph.apply(operator.mul, self, other)
+
+    def __rmul__(self, other):
+        return self.graph.apply(operator.mul, other, self)
+
+    def __truediv__(self, other):
+        return self.graph.apply(operator.truediv, self, other)
+
+    def __pow__(self, other):
+        return self.graph.apply(operator.pow, self, other)
+
+    def __str__(self):
+        args = [f'%{arg.idx}' if isinstance(arg, Node) else repr(arg) for arg in self.args]
+        args += [f'{key}={val!r}' for key, val in self.kwargs.items()]
+        return f'%{self.idx} = {self.func.__name__}({", ".join(args)})'
+
+
+class VarGraph:
+    """**Evaluation plan for a set of Variables**
+
+    Every Variable is split into VarGetter reads (leaves) and numpy
+    operations on them, with identical nodes shared between variables, so
+    ie `eta(TightLeptons, 0)` is computed once for all variables using it.
+    Functions without a registered builder are kept as a single leaf.
+    Each output is cast to the dtype of its Variable as soon as it is
+    computed, so only the intermediate steps are held in float64.
+
+    Args:
+      use_vars(dict): Variable name to Variable
+    """
+    def __init__(self, use_vars):
+        self.nodes = list()
+        self._interned = dict()
+        self.outputs = {name: self.compile(var) for name, var in use_vars.items()}
+        self.dtypes = {name: var.getType() for name, var in use_vars.items()}
+
+        self._last_use = dict()
+        for node in self.nodes:
+            for arg in node.args:
+                if isinstance(arg, Node):
+                    self._last_use[arg] = node.idx
+        self._output_names = dict()
+        for name, node in self.outputs.items():
+            self._output_names.setdefault(node, list()).append(name)
+
+    def compile(self, var):
+        inputs = (var.inputs,) if isinstance(var.inputs, str) else var.inputs
+        if var.func in builders:
+            return builders[var.func](self, *inputs)
+        return self.get(var.func, *inputs)
+
+    def get(self, func, *args):
+        """Leaf node calling func(VarGetter, *args)"""
+        return self._intern(func, args, dict(), leaf=True)
+
+    def apply(self, func, *args, **kwargs):
+        """Node calling func on the values of its arguments"""
+        return self._intern(func, args, kwargs, leaf=False)
+
+    def kernel(self, kern, *args):
+        """Single node for a compiled kernel, otherwise its NumPy version
+        is traced into nodes so the intermediate steps are shared"""
+        if kern.compiled:
+            return self.apply(kern, *args)
+        return kern.numpy(*args)
+
+    def _intern(self, func, args, kwargs, leaf):
+        key = (func, args, tuple(sorted(kwargs.items())), leaf)
+        if key not in self._interned:
+            node = Node(self, len(self.nodes), func, args, kwargs, leaf)
+            self.nodes.append(node)
+            self._interned[key] = node
+        return self._interned[key]
+
+    def evaluate(self, arr):
+        """Compute every output for a VarGetter, each node once
+
+        Returns:
+          dict: variable name to numpy array of the Variable's dtype
+        """
+        values = dict()
+        outputs = dict()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for node in self.nodes:
+                if node.leaf:
+                    values[node] = node.func(arr, *node.args)
+                else:
+                    args = [values[arg] if isinstance(arg, Node) else arg for arg in node.args]
+                    values[node] = node.func(*args, **node.kwargs)
+                for name in self._output_names.get(node, []):
+                    outputs[name] = np.asarray(values[node]).astype(self.dtypes[name], copy=False)
+                for arg in set(node.args):
+                    if isinstance(arg, Node) and self._last_use[arg] == node.idx:
+                        del values[arg]
+                if node not in self._last_use:
+                    del values[node]
+        return {name: outputs[name] for name in self.outputs}
+
+    def __str__(self):
+        lines = [str(node) for node in self.nodes]
+        width = max(map(len, self.outputs), default=0)
+        lines += [f'{name:{width}} <- %{node.idx}' for name, node in self.outputs.items()]
+        return "\n".join(lines)
+
+    # VarGetter reads, all particle variables go through nth
+
+    def nth(self, part, name, n=0, fill=-1):
+        return self.get(vg.nth, part, name, n, fill)
+
+    def pt(self, part, n, fill=-1):
+        return self.nth(part, "pt", n, fill)
+
+    def eta(self, part, n, fill=-1):
+        return self.nth(part, "eta", n, fill)
+
+    def phi(self, part, n, fill=-1):
+        return self.nth(part, "phi", n, fill)
+
+    def pmass(self, part, n, fill=-1):
+        return self.nth(part, "mass", n, fill)
+
+    def momenta(self, part, n):
+        return self.pt(part, n), self.eta(part, n), self.phi(part, n)
+
+    def var(self, name):
+        return self.get(vg.var, name)
+
+
+# Builders mirror the VarGetter functions
+
+@builds(vg.var)
+def _var(g, name):
+    return g.var(name)
+
+@builds(vg.nth)
+def _nth(g, part, name, n=0, fill=-1):
+    return g.nth(part, name, n, fill)
+
+@builds(vg.pt)
+def _pt(g, part, n, fill=-1):
+    return g.pt(part, n, fill)
+
+@builds(vg.eta)
+def _eta(g, part, n, fill=-1):
+    return g.eta(part, n, fill)
+
+@builds(vg.phi)
+def _phi(g, part, n, fill=-1):
+    return g.phi(part, n, fill)
+
+@builds(vg.pmass)
+def _pmass(g, part, n, fill=-1):
+    return g.pmass(part, n, fill)
+
+@builds(vg.abseta)
+def _abseta(g, part, n, fill=-1):
+    return np.nan_to_num(np.abs(g.nth(part, "eta", n, np.nan)), nan=-1)
+
+@builds(vg.mt)
+def _mt(g, part, n, fill=-1):
+    return g.kernel(kernels.mt, g.pt(part, n), g.phi(part, n), g.var("Met"), g.var("Met_phi"))
+
+@builds(vg.dr)
+def _dr(g, part1, idx1, part2, idx2):
+    return g.kernel(kernels.dr, g.eta(part1, idx1), g.phi(part1, idx1),
+                    g.eta(part2, idx2), g.phi(part2, idx2))
+
+@builds(vg.mass)
+def _mass(g, part1, idx1, part2, idx2):
+    return g.kernel(kernels.mass, *g.momenta(part1, idx1), *g.momenta(part2, idx2))
+
+@builds(vg.true_mass)
+def _true_mass(g, part1, idx1, part2, idx2):
+    return g.kernel(kernels.true_mass, g.pmass(part1, idx1), *g.momenta(part1, idx1),
+                    g.pmass(part2, idx2), *g.momenta(part2, idx2))
+
+@builds(vg.cosDtheta)
+def _cosDtheta(g, part1, idx1, part2, idx2):
+    return g.kernel(kernels.cosDtheta, g.eta(part1, idx1), g.phi(part1, idx1),
+                    g.eta(part2, idx2), g.phi(part2, idx2))
@@ -4,33 +4,95 @@ from pathlib import Path
 import logging
 
 import analysis_suite.commons.configs as config
+from analysis_suite.commons.metadata import load_metadata, share_metadata
+from analysis_suite.commons.tables import table_path
 from .data_processor import DataProcessor
+from .vargetter import VarGetter
+from .cache import ColumnCache
+from .profiler import Profiler
+from . import kernels
 import analysis_suite.data.inputs as mva_params
 
+# Metadata of the input files, sent once to each worker (see Scheduler)
+shared = dict()
+
+def preload():
+    share_metadata(shared.get("metadata", dict()).values())
+
+def input_files(infile):
+    return sorted(infile.rglob("*.root")) if infile.is_dir() else [infile]
+
 def setup(cli_args):
     argList = list()
-    allSysts = config.get_list_systs(**vars(cli_args))
+    # sorted so the task names (journal, --resume and timings keys) are the same every run
+    allSysts = sorted(config.get_list_systs(**vars(cli_args)))
+    if cli_args.dry_run:
+        kernels.set_backend(cli_args.backend)
+        print(DataProcessor(mva_params.allvar, list(allSysts)).branch_report())
+        return argList
     trees = config.get_trees(cli_args.years)
+    options = {"step_size": cli_args.step_size, "backend": cli_args.backend,
+               "format": cli_args.format, "cache": not cli_args.no_cache,
+               "hash_inputs": cli_args.hash_inputs, "file_jobs": cli_args.file_jobs,
+               "profile": cli_args.profile}
 
     for year in cli_args.years:
         outdir = cli_args.workdir / year
         config.checkOrCreateDir(outdir)
         # infile = Path(f'result_{year}.root')
         infile = Path(f'test.root')
+        shared.setdefault("metadata", dict()).update(
+            (str(root_file), load_metadata(root_file)) for root_file in input_files(infile))
         for tree in trees:
-            if tree == "Analyzed":
-                for syst in allSysts:
-                    argList.append((infile, outdir, tree, year, syst))
+            if tree == "Analyzed" and cli_args.single_pass:
+                argList.append((infile, outdir, tree, year, list(allSysts), options))
+            elif tree == "Analyzed":
+                for systs in group_jec_systs(allSysts):
+                    argList.append((infile, outdir, tree, year, systs, options))
             else:
-                argList.append((infile, outdir, tree, year, "Nominal"))
+                argList.append((infile, outdir, tree, year, "Nominal", options))
 
     return argList
         
 
-def run(infile, outdir, tree, year, syst):
-    data = DataProcessor(mva_params.allvar, syst)
-    logging.info(f'Processing year {year} with syst {syst} MC')
-    data.process_year(infile, outdir, tree)
+def group_jec_systs(allSysts):
+    """Jobs for each systematic, with the JES/JER variations run in the
+    same job as Nominal so their jets are shifted from one read"""
+    jec_systs = [syst for syst in allSysts if VarGetter.jec_name(syst) is not None]
+    if "Nominal" not in allSysts or not jec_systs:
+        return list(allSysts)
+    jobs = [["Nominal"] + jec_systs]
+    return jobs + [syst for syst in allSysts if syst not in jobs[0]]
+
+
+def run(infile, outdir, tree, year, syst, options):
+    kernels.set_backend(options["backend"])
+    data = DataProcessor(mva_params.allvar, syst, options["format"])
+    cache = None
+    if options["profile"]:
+        data.profiler = Profiler()
+    elif options["cache"]:
+        cache = ColumnCache(outdir / ".cache", options["hash_inputs"])
+    logging.info(f'Processing year {year} with syst(s) {syst} MC')
+    data.process_year(infile, outdir, tree, options["step_size"], cache, options["file_jobs"])
+
+
+def task_cost(infile, outdir, tree, year, syst, options):
+    """Uncompressed bytes of the tree to read, times the systematics made"""
+    nbytes = sum(group.trees[tree]["uncompressed_bytes"]
+                 for root_file in input_files(infile)
+                 for group in load_metadata(root_file).groups.values() if tree in group.trees)
+    return nbytes*(1 if isinstance(syst, str) else len(syst))
+
+
+def task_inputs(infile, outdir, tree, year, syst, options):
+    return input_files(infile)
+
+
+def task_outputs(infile, outdir, tree, year, syst, options):
+    systs = [syst] if isinstance(syst, str) else syst
+    treename = "" if tree == "Analyzed" else f'_{tree}'
+    return [table_path(outdir / f'processed_{syst}{treename}', options["format"]) for syst in systs]
 
 
 def cleanup(cli_args):
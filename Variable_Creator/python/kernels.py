@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+.. module:: kernels
+   :synopsis: Kinematic functions used by VarGetter, with an optional numba backend
+
+Every kernel has a NumPy version, which is the reference, and can have
+a compiled loop that computes each event in one pass without the full
+length temporaries. The compiled loops work in float64 and cast back to
+the NumPy result type. With float64 inputs they agree with the NumPy
+version to rtol=1e-10 (libm and NumPy transcendentals differ by an ulp,
+amplified where cosh(deta) - cos(dphi) cancels). With float32 inputs
+they equal the NumPy version run on float64 copies of the inputs and
+rounded to float32, so they differ from NumPy in float32 where those
+cancellations lose precision. Measured on 2M uniform events (pt 20-500,
+|eta| < 2.5): dr within 2e-7 relative; mass, true_mass and cosDtheta
+within 2e-5 relative for 99.9% of events but up to 1e-2 (mass,
+true_mass) and 3e-2 (cosDtheta) for nearly collinear pairs, ie 6e-3 GeV
+absolute; mt up to 0.1 GeV absolute when the particle is along the Met.
+
+The NumPy versions are used by default. `set_backend("numba")` (analyze
+`--backend numba`) turns on the compiled loops if numba is installed;
+numba is only imported, and the loops compiled, when a kernel is first
+called.
+"""
+import math
+import warnings
+from importlib.util import find_spec
+import numpy as np
+
+has_numba = find_spec("numba") is not None
+
+backend = "numpy"
+
+def set_backend(name):
+    global backend
+    if name == "numba" and not has_numba:
+        warnings.warn("numba is not installed, using the numpy backend")
+        name = "numpy"
+    backend = name
+
+
+class Kernel:
+    """NumPy function with an optional compiled loop computing the same thing"""
+    def __init__(self, func):
+        self.numpy = func
+        self.python_loop = None
+        self.loop = None
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def compiles(self, loop):
+        if has_numba:
+            self.python_loop = loop
+        return loop
+
+    @property
+    def compiled(self):
+        return backend == "numba" and self.python_loop is not None
+
+    def __call__(self, *args):
+        if not self.compiled:
+            return self.numpy(*args)
+        args = [np.asarray(arg) for arg in args]
+        dtype = np.result_type(*[arg for arg in args if arg.dtype.kind == "f"])
+        args = [arg if arg.dtype.kind in "iu" else np.ascontiguousarray(arg, dtype=np.float64)
+                for arg in args]
+        if self.loop is None:
+            import numba
+            self.loop = numba.njit(cache=True, error_model="numpy")(self.python_loop)
+        return self.loop(*args).astype(dtype, copy=False)
+
+
+@Kernel
+def dr(eta1, phi1, eta2, phi2):
+    eta_sq = eta1**2 + eta2**2
+    phi_sq = phi1**2 + phi2**2
+    return np.sqrt(eta_sq+phi_sq)
+
+@dr.compiles
+def _dr(eta1, phi1, eta2, phi2):
+    out = np.empty(len(eta1))
+    for i in range(len(eta1)):
+        out[i] = math.sqrt((eta1[i]**2 + eta2[i]**2) + (phi1[i]**2 + phi2[i]**2))
+    return out
+
+
+@Kernel
+def mass(pt1, eta1, phi1, pt2, eta2, phi2):
+    # This assumes E ~ p or p >> m (true for light particles)
+    cosh_deta = np.cosh(eta1 - eta2)
+    cos_dphi = np.cos(phi1 - phi2)
+    pt = 2*pt1*pt2
+    return np.sqrt(pt*(cosh_deta - cos_dphi))
+
+@mass.compiles
+def _mass(pt1, eta1, phi1, pt2, eta2, phi2):
+    out = np.empty(len(pt1))
+    for i in range(len(pt1)):
+        pt = 2*pt1[i]*pt2[i]
+        out[i] = math.sqrt(pt*(math.cosh(eta1[i] - eta2[i]) - math.cos(phi1[i] - phi2[i])))
+    return out
+
+
+@Kernel
+def true_mass(m1, pt1, eta1, phi1, m2, pt2, eta2, phi2):
+    e1 = np.sqrt(m1**2 + pt1*np.cosh(eta1)**2)
+    e2 = np.sqrt(m2**2 + pt2*np.cosh(eta2)**2)
+    pt_part = 2*pt1*pt2
+    phi_part = np.cos(phi1 - phi2)
+    eta_part = np.sinh(eta1)*np.sinh(eta2)
+    return np.sqrt(m1**2 + m2**2 + 2*e1*e2 - pt_part*(phi_part + eta_part))
+
+@true_mass.compiles
+def _true_mass(m1, pt1, eta1, phi1, m2, pt2, eta2, phi2):
+    out = np.empty(len(pt1))
+    for i in range(len(pt1)):
+        e1 = math.sqrt(m1[i]**2 + pt1[i]*math.cosh(eta1[i])**2)
+        e2 = math.sqrt(m2[i]**2 + pt2[i]*math.cosh(eta2[i])**2)
+        pt_part = 2*pt1[i]*pt2[i]
+        phi_part = math.cos(phi1[i] - phi2[i])
+        eta_part = math.sinh(eta1[i])*math.sinh(eta2[i])
+        out[i] = math.sqrt(m1[i]**2 + m2[i]**2 + 2*e1*e2 - pt_part*(phi_part + eta_part))
+    return out
+
+
+@Kernel
+def cosDtheta(eta1, phi1, eta2, phi2):
+    cosh_eta = np.cosh(eta1)*np.cosh(eta2)
+    sinh_eta = np.sinh(eta1)*np.sinh(eta2)
+    cos_dphi = np.cos(phi1 - phi2)
+    return (cos_dphi - sinh_eta)/cosh_eta
+
+@cosDtheta.compiles
+def _cosDtheta(eta1, phi1, eta2, phi2):
+    out = np.empty(len(eta1))
+    for i in range(len(eta1)):
+        cosh_eta = math.cosh(eta1[i])*math.cosh(eta2[i])
+        sinh_eta = math.sinh(eta1[i])*math.sinh(eta2[i])
+        out[i] = (math.cos(phi1[i] - phi2[i]) - sinh_eta)/cosh_eta
+    return out
+
+
+@Kernel
+def mt(pt, phi, met, met_phi):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        angle_part = (1-np.cos(phi-met_phi))
+        total = np.sqrt(2*pt*met*angle_part)
+    return np.nan_to_num(total, nan=-1)
+
+@mt.compiles
+def _mt(pt, phi, met, met_phi):
+    out = np.empty(len(pt))
+    for i in range(len(pt)):
+        total = math.sqrt(2*pt[i]*met[i]*(1-math.cos(phi[i]-met_phi[i])))
+        out[i] = -1 if math.isnan(total) else total
+    return out
+
+
+@Kernel
+def mwT(counts, phi, pt, met, met_phi):
+    """Transverse mass of the Met and the particle closest to it in phi.
+    Takes the particles as counts per event and flat contents, events
+    without particles get -1"""
+    event = np.repeat(np.arange(len(counts)), counts)
+    cos_angles = np.cos(phi-met_phi[event])
+    # first maximum in each event, like argmax
+    closest = np.lexsort((-cos_angles, event))[(np.cumsum(counts) - counts)[counts > 0]]
+    has_part = counts > 0
+    out = np.full(len(counts), -1, dtype=np.result_type(pt, met, cos_angles))
+    out[has_part] = np.sqrt(2*met[has_part]*pt[closest]*(1 - cos_angles[closest]))
+    return out
+
+@mwT.compiles
+def _mwT(counts, phi, pt, met, met_phi):
+    out = np.full(len(counts), -1.)
+    start = 0
+    for i in range(len(counts)):
+        best = -1
+        best_cos = -2.
+        for j in range(start, start + counts[i]):
+            cos_angle = math.cos(phi[j] - met_phi[i])
+            if cos_angle > best_cos:
+                best, best_cos = j, cos_angle
+        if best >= 0:
+            out[i] = math.sqrt(2*met[i]*pt[best]*(1 - best_cos))
+        start += counts[i]
+    return out
@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 import math
+import time
+import inspect
 import awkward1 as ak
 import uproot4 as uproot
 import numpy as np
-from analysis_suite.commons.configs import get_metadata
+from copy import copy
+from analysis_suite.commons.metadata import GroupMeta
+from . import kernels
+from .dedup import EventIndex, event_keys, event_ids
 from analysis_suite.commons.info import FileInfo
 from dataclasses import dataclass
 from typing import Callable
 
+def reads(*templates):
+    """Declare the branches a VarGetter function reads. Templates are
+    formatted with the arguments the function is called with"""
+    def wrapper(func):
+        func.branches = templates
+        return func
+    return wrapper
+
+
 @dataclass
 class Variable:
     func: Callable[..., dict]
     inputs: tuple
+    dtype: type = None
 
     def apply(self, arr):
         if isinstance(self.inputs, str):
@@ -19,145 +34,371 @@ class Variable:
         else:
             return self.func(arr, *self.inputs)
 
+    def branches(self, jecs=()):
+        """Set of branches needed to compute this variable
+
+        Args:
+          jecs(iterable): JEC branch names (ie `jes/jes.first`) in use, added
+            for every jet pt read
+        """
+        branches = {branch.format(**self._arguments()) for branch in self.func.branches}
+        for branch in list(branches):
+            part, _, name = branch.rpartition("/")
+            if "Jet" in part and name == "pt":
+                branches |= {f'{part}/{jec}' for jec in jecs}
+        return branches
+
+    def depths(self):
+        """Number of entries of each particle this variable looks at"""
+        args = self._arguments()
+        depths = dict()
+        for part, n in [("part", "n"), ("part1", "idx1"), ("part2", "idx2")]:
+            if part in args and n in args:
+                depths[args[part]] = max(depths.get(args[part], 0), args[n]+1)
+        return depths
+
+    def _arguments(self):
+        inputs = (self.inputs,) if isinstance(self.inputs, str) else self.inputs
+        args = inspect.signature(self.func).bind(None, *inputs)
+        args.apply_defaults()
+        return args.arguments
+
     def getType(self):
+        """Output type, if not given int32 for counts (`num` or `n_` inputs)
+        and float32 otherwise, as before dtypes could be set"""
+        if self.dtype is not None:
+            return np.dtype(self.dtype)
         isInt = "num" in repr(self.func) or "n_" in self.inputs
-        return "int" if isInt else "float"
+        return np.dtype(np.int32 if isInt else np.float32)
+
+def pad_dense(counts, contents, depth):
+    """Turn a jagged array given as counts and flat contents into a dense
+    (events, depth) array, clipping longer lists and zero filling shorter ones"""
+    take = np.minimum(counts, depth)
+    starts = np.cumsum(counts) - counts
+    rows = np.repeat(np.arange(len(counts)), take)
+    cols = np.arange(np.sum(take)) - np.repeat(np.cumsum(take) - take, take)
+    dense = np.zeros((len(counts), depth), dtype=contents.dtype)
+    dense[rows, cols] = contents[np.repeat(starts, take) + cols]
+    return dense
+
 
 class VarGetter:
     branch_names = None
-    def __init__(self, f, tree, group, syst=0):
-        self.syst = syst
-        self.syst_bit = 2**self.syst
-        self.jec = None
-        if self.branch_names is None:
-            branches = [key for key, array in f[group][tree].items()
-                        if len(array.keys()) == 0]
-        else:
-            branches = [key for key in f[group][tree].keys()
-                        if key in self.branch_names] + ["weight"]
-        analysis = get_metadata(f[group]["MetaData"], "Analysis")
-        year = get_metadata(f[group]["MetaData"], "Year")
-        self.xsec = float(get_metadata(f[group]["MetaData"], "Xsec"))
-        self.sumw = sum(f[group]["sumweight"].values())
-
-        if f[group][tree].num_entries != 0:
-            analyzed = f[group][tree]
-            passMask = analyzed["PassEvent"].array()[:, self.syst]
-            self.arr = analyzed.arrays(branches)[passMask]
-            self.scale = self.arr["weight"][:,self.syst]*self.xsec/self.sumw
-            if group == "data":
-                self.remove_dup()
+    depths = dict()
+    base_branches = ["weight", "PassEvent", "run", "lumiBlock", "event"]
+    jec_variations = ["jes/jes.first", "jes/jes.second", "jer/jer.first", "jer/jer.second"]
+    def __init__(self, f, tree, group, syst=0, branch_names=None, dedup=True, meta=None):
+        """Read the tree of a group once. `syst` can be a single systematic
+        index or a list of them: events failing all of them are dropped on
+        read and `set_syst` chooses which one is worked on afterwards.
+        Only `branch_names` are read if given (see `required_branches`).
+        Duplicate data events are removed within the file, or against
+        all events already in `dedup` if it is an EventIndex, or kept
+        if `dedup` is False. `meta` (GroupMeta) saves parsing the
+        MetaData of the group again
+        """
+        self._read_metadata(f, group, syst, meta)
+        analyzed = f[group][tree]
+        self.entries = analyzed.num_entries
+        if analyzed.num_entries != 0:
+            start = time.perf_counter()
+            arrays = analyzed.arrays(self._get_branches(analyzed, branch_names))
+            self.read_time = time.perf_counter() - start
+            self._set_arrays(arrays, dedup)
         else:
-            self.arr = ak.Array([])
-            self.scale = ak.Array([])
+            self.all_arr = ak.Array([])
+            self._flat_cache = dict()
+        self.set_syst(self.systs[0])
 
-    def __add__(self, other):
-        sumwTot = self.sumw + other.sumw
-        self.arr = ak.concatenate((self.arr, other.arr))
-        self.scale = ak.concatenate((self.sumw*self.scale, other.sumw*other.scale))/sumwTot
-        self.sumw = sumwTot
-        return self
+    @classmethod
+    def iterate(cls, f, tree, group, syst=0, branch_names=None, step_size=100000, dedup=True,
+                meta=None):
+        """Yield a VarGetter for each chunk of `step_size` entries of the tree
+
+        Only one chunk is kept in memory at a time. The `sumw` of each chunk
+        is that of the file: set it to the total of the group before using
+        the scale if the group is spread over several files. Data events
+        are deduplicated across the chunks, and across files if `dedup`
+        is an EventIndex shared between them.
+        """
+        base = cls.__new__(cls)
+        base._read_metadata(f, group, syst, meta)
+        analyzed = f[group][tree]
+        if analyzed.num_entries == 0:
+            return
+        if dedup is True:
+            dedup = EventIndex()
+        branches = base._get_branches(analyzed, branch_names)
+        start = time.perf_counter()
+        for chunk in analyzed.iterate(branches, step_size=step_size):
+            arr = copy(base)
+            arr.read_time = time.perf_counter() - start
+            arr.entries = len(chunk)
+            arr._set_arrays(chunk, dedup)
+            arr.set_syst(arr.systs[0])
+            yield arr
+            start = time.perf_counter()
+
+    def _read_metadata(self, f, group, syst, meta=None):
+        if meta is None:
+            meta = GroupMeta.read(f, group)
+        self.group = group
+        self.read_time = 0.
+        self.systs = [syst] if isinstance(syst, int) else list(syst)
+        self.jec = None
+        self.isData = meta.isData
+        self.xsec = meta.xsec
+        self.sumw = meta.sumw
+
+    def _get_branches(self, analyzed, branch_names):
+        if branch_names is None:
+            branch_names = self.branch_names
+        if branch_names is None:
+            self.read_branches = [key for key, array in analyzed.items() if len(array.keys()) == 0]
+            return self.read_branches
+        branch_names = set(branch_names) | set(self.base_branches)
+        self.read_branches = [key for key in analyzed.keys() if key in branch_names]
+        return self.read_branches
+
+    def _set_arrays(self, arr, dedup=True):
+        passEvent = arr["PassEvent"]
+        passMask = np.any([ak.to_numpy(passEvent[:, s]) for s in self.systs], axis=0)
+        self.all_arr = arr[passMask]
+        if self.isData and dedup is not False:
+            self.remove_dup(dedup if isinstance(dedup, EventIndex) else None)
+        self._flat_cache = dict()
 
     def __len__(self):
         return len(self.scale)
 
-    def remove_dup(self):
-        _, unique_idx = np.unique(ak.to_numpy(self.arr.event), return_index=True)
-        self.arr = self.arr[unique_idx]
-        self.scale = self.scale[unique_idx]
+    @property
+    def arr(self):
+        if self._arr is None:
+            if len(self.all_arr):
+                self._arr = self.all_arr[self.all_arr["PassEvent"][:, self.syst]]
+            else:
+                self._arr = self.all_arr
+        return self._arr
+
+    @property
+    def scale(self):
+        if self._scale is None:
+            if len(self.arr):
+                self._scale = self.arr["weight"][:, self.syst]*self.xsec/self.sumw
+            else:
+                self._scale = ak.Array([])
+        return self._scale
+
+    def set_syst(self, syst, systName=None):
+        """Switch to systematic index `syst`. Only the event mask and weights
+        are recomputed (lazily), the arrays read from file are reused
+        """
+        self.syst = syst
+        self.syst_bit = 2**self.syst
+        self._arr = None
+        self._scale = None
+        self._cache = dict()
+        if systName is not None:
+            self.set_JEC(systName)
+
+    def clear_cache(self):
+        """Forget all arrays derived from the read, ie for profiling"""
+        self._cache = dict()
+        self._flat_cache = dict()
+
+    def remove_dup(self, index=None):
+        """Remove duplicate events, keyed on (run, luminosityBlock, event),
+        also those already in `index` if given. The first copy is kept
+
+        Args:
+          index(EventIndex, optional): Events kept so far, updated in place
+        """
+        if index is None:
+            index = EventIndex()
+        self.all_arr = self.all_arr[index.add(self.event_keys(self.all_arr))]
+
+    def event_keys(self, arr=None):
+        """Keys of the events of the current systematic, or of `arr`"""
+        arr = self.arr if arr is None else arr
+        return event_keys(ak.to_numpy(arr["run"]), ak.to_numpy(arr["lumiBlock"]),
+                          ak.to_numpy(arr["event"]))
+
+    def event_ids(self):
+        """Ids of the events of the current systematic (see `dedup.event_ids`)"""
+        return event_ids(self.event_keys())
 
     def set_JEC(self, systName):
+        self.jec = self.jec_name(systName)
+
+    @staticmethod
+    def jec_name(systName):
         systNames = systName.lower().split('_')
         if len(systNames) != 3 or systNames[1] not in ["jes", "jer"]:
-            return
+            return None
         updown = {"down": "first", "up": "second"}
-        self.jec = f'{systNames[1]}/{systNames[1]}.{updown[systNames[2]]}'
+        return f'{systNames[1]}/{systNames[1]}.{updown[systNames[2]]}'
+
+    @classmethod
+    def required_branches(cls, use_vars, systNames=["Nominal"]):
+        """Branches each variable reads, for the given systematics
+
+        Returns:
+          dict: variable name to set of branches
+        """
+        jecs = {jec for syst in systNames if (jec := cls.jec_name(syst)) is not None}
+        return {name: var.branches(jecs) for name, var in use_vars.items()}
+
+    def flat(self, part, name):
+        """**Particle branch as counts and flat contents, for every event read**
+
+        Kept when changing systematic: each systematic only selects
+        from these with `get_part_mask`, without touching the jagged
+        arrays again.
+        """
+        key = (part, name)
+        if key not in self._flat_cache:
+            var = self.all_arr[f'{part}/{name}']
+            self._flat_cache[key] = (ak.to_numpy(ak.num(var, axis=1)), self.flatten(var))
+        return self._flat_cache[key]
+
+    def jec_pt(self, part):
+        """**Pt of a particle with every JEC variation read**
 
-    def setup_scale(self):
-        self.scale *= self.xsec/self.sumw
+        All variations are made together from one copy of the pt, so the
+        JES/JER systematics run next to Nominal at little extra cost.
+
+        Returns:
+          dict: JEC name (None for no JEC) to flat pt
+        """
+        key = (part, "pt", "jec")
+        if key not in self._flat_cache:
+            _, pt = self.flat(part, "pt")
+            shifted = {None: pt}
+            for jec in self.jec_variations:
+                if f'{part}/{jec}' in self.read_branches:
+                    shifted[jec] = pt*self.flat(part, jec)[1]
+            self._flat_cache[key] = shifted
+        return self._flat_cache[key]
+
+    @property
+    def event_mask(self):
+        """Events read that pass the current systematic"""
+        if "PassEvent" not in self._cache:
+            self._cache["PassEvent"] = ak.to_numpy(self.all_arr["PassEvent"][:, self.syst])
+        return self._cache["PassEvent"]
 
     def get_part_mask(self, part):
-        return np.bitwise_and(self.arr["{}/syst_bitMap".format(part)], self.syst_bit) != 0
+        """**Particles passing the current systematic**
+
+        Returns:
+          tuple: mask on the flat contents (see `flat`) and the number of
+            particles kept in each event passing the systematic
+        """
+        key = (part, "syst_bitMap", self.syst, None)
+        if key not in self._cache:
+            counts, bitmap = self.flat(part, "syst_bitMap")
+            mask = (np.bitwise_and(bitmap, self.syst_bit) != 0) & np.repeat(self.event_mask, counts)
+            event = np.repeat(np.arange(len(counts)), counts)
+            part_counts = np.bincount(event[mask], minlength=len(counts))[self.event_mask]
+            self._cache[key] = (mask, part_counts)
+        return self._cache[key]
+
+    def padded(self, part, name, depth=1):
+        """**Masked particle variable as a dense array, memoised**
+
+        The array is padded to the deepest entry asked for this particle
+        (see `depths`) so every `nth` call on it is served from one copy.
+        Jet pt has the current JEC applied.
+
+        Returns:
+          tuple: (events, depth) array and the number of particles per event
+        """
+        jec = self.jec if "Jet" in part and name == "pt" else None
+        key = (part, name, self.syst, jec)
+        depth = max(depth, self.depths.get(part, 1))
+        if key not in self._cache or self._cache[key][0].shape[1] < depth:
+            mask, counts = self.get_part_mask(part)
+            if "Jet" in part and name == "pt":
+                contents = self.jec_pt(part)[jec]
+            else:
+                _, contents = self.flat(part, name)
+            self._cache[key] = (pad_dense(counts, contents[mask], depth), counts)
+        return self._cache[key]
 
+    @reads("{part}/syst_bitMap")
     def num(self, part):
-        return ak.to_numpy(ak.count(self.get_part_mask(part), axis=1))
+        """Number of particles in each event, whether or not they pass the
+        systematic (like `ak.count` of the bitmap mask)"""
+        counts, _ = self.flat(part, "syst_bitMap")
+        return counts[self.event_mask]
 
+    @reads("{part}/pt", "{part}/syst_bitMap")
     def pt(self, part, n, fill=-1):
-        if "Jet" in part and self.jec is not None:
-            return self.nth(part, "pt", n, fill)*self.nth(part, self.jec, n, fill)
-        else:
-            return self.nth(part, "pt", n, fill)
+        return self.nth(part, "pt", n, fill)
 
+    @reads("{part}/eta", "{part}/syst_bitMap")
     def eta(self, part, n, fill=-1):
         return self.nth(part, "eta", n, fill)
 
+    @reads("{part}/eta", "{part}/syst_bitMap")
     def abseta(self, part, n, fill=-1):
         abseta = np.nan_to_num(np.abs(self.nth(part, "eta", n, np.nan)), nan=-1)
         return abseta
 
+    @reads("{part}/phi", "{part}/syst_bitMap")
     def phi(self, part, n, fill=-1):
         return self.nth(part, "phi", n, fill)
 
+    @reads("{part}/mass", "{part}/syst_bitMap")
     def pmass(self, part, n, fill=-1):
         return self.nth(part, "mass", n, fill)
 
+    @reads("{part}/pt", "{part}/phi", "{part}/syst_bitMap", "Met", "Met_phi")
     def mt(self, part, n, fill=-1):
-        import warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            angle_part = (1-np.cos(self.phi(part, n)-self.var("Met_phi")))
-            total = np.sqrt(2*self.pt(part, n)*self.var("Met")*angle_part)
-        return np.nan_to_num(total, nan=-1)
-
+        return kernels.mt(self.pt(part, n), self.phi(part, n), self.var("Met"), self.var("Met_phi"))
 
+    @reads("{part}/{name}", "{part}/syst_bitMap")
     def nth(self, part, name, n=0, fill=-1):
-        var = self.arr[f'{part}/{name}'][self.get_part_mask(part)]
-        return ak.to_numpy(ak.fill_none(ak.pad_none(var, n+1, axis=1, clip=True)[:,n], fill))
+        values, counts = self.padded(part, name, n+1)
+        return np.where(counts > n, values[:, n], fill)
 
+    @reads("{part1}/eta", "{part1}/phi", "{part1}/syst_bitMap",
+           "{part2}/eta", "{part2}/phi", "{part2}/syst_bitMap")
     def dr(self, part1, idx1, part2, idx2):
-        eta2 = self.eta(part1, idx1)**2 + self.eta(part2, idx2)**2
-        phi2 = self.phi(part1, idx1)**2 + self.phi(part2, idx2)**2
-        return np.sqrt(eta2+phi2)
+        return kernels.dr(self.eta(part1, idx1), self.phi(part1, idx1),
+                          self.eta(part2, idx2), self.phi(part2, idx2))
 
+    @reads("{part1}/pt", "{part1}/eta", "{part1}/phi", "{part1}/syst_bitMap",
+           "{part2}/pt", "{part2}/eta", "{part2}/phi", "{part2}/syst_bitMap")
     def mass(self, part1, idx1, part2, idx2):
-        # This assumes E ~ p or p >> m (true for light particles)
-        cosh_deta = np.cosh(self.eta(part1, idx1) - self.eta(part2, idx2))
-        cos_dphi = np.cos(self.phi(part1, idx1) - self.phi(part2, idx2))
-        pt = 2*self.pt(part1, idx1)*self.pt(part2, idx2)
-        return np.sqrt(pt*(cosh_deta - cos_dphi))
+        return kernels.mass(*self.momenta(part1, idx1), *self.momenta(part2, idx2))
 
+    @reads("{part1}/pt", "{part1}/eta", "{part1}/phi", "{part1}/mass", "{part1}/syst_bitMap",
+           "{part2}/pt", "{part2}/eta", "{part2}/phi", "{part2}/mass", "{part2}/syst_bitMap")
     def true_mass(self, part1, idx1, part2, idx2):
-        m1 = self.pmass(part1, idx1)
-        m2 = self.pmass(part2, idx2)
-        e1 = np.sqrt(m1**2 + self.pt(part1, idx1)*np.cosh(self.eta(part1, idx1))**2)
-        e2 = np.sqrt(m2**2 + self.pt(part2, idx2)*np.cosh(self.eta(part2, idx2))**2)
-        pt_part = 2*self.pt(part1, idx1)*self.pt(part2, idx2)
-        phi_part = np.cos(self.phi(part1, idx1) - self.phi(part2, idx2))
-        eta_part = np.sinh(self.eta(part1, idx1))*np.sinh(self.eta(part2, idx2))
-
-        return np.sqrt(m1**2 + m2**2 + 2*e1*e2 - pt_part*(phi_part + eta_part))
-    
+        return kernels.true_mass(self.pmass(part1, idx1), *self.momenta(part1, idx1),
+                                 self.pmass(part2, idx2), *self.momenta(part2, idx2))
+
+    @reads("{part1}/eta", "{part1}/phi", "{part1}/syst_bitMap",
+           "{part2}/eta", "{part2}/phi", "{part2}/syst_bitMap")
     def cosDtheta(self, part1, idx1, part2, idx2):
-        cosh_eta = np.cosh(self.eta(part1, idx1))*np.cosh(self.eta(part2, idx2))
-        sinh_eta = np.sinh(self.eta(part1, idx1))*np.sinh(self.eta(part2, idx2))
-        cos_dphi = np.cos(self.phi(part1, idx1) - self.phi(part2, idx2))
+        return kernels.cosDtheta(self.eta(part1, idx1), self.phi(part1, idx1),
+                                 self.eta(part2, idx2), self.phi(part2, idx2))
 
-        return (cos_dphi - sinh_eta)/cosh_eta
+    def momenta(self, part, n):
+        return self.pt(part, n), self.eta(part, n), self.phi(part, n)
 
+    @reads("{name}")
     def var(self, name):
         return ak.to_numpy(self.arr[name][:,self.syst])
 
-    ##### Need to fix
-
+    @reads("{part}/pt", "{part}/phi", "{part}/syst_bitMap", "Met", "Met_phi")
     def mwT(self, part):
-        part_phi = self.arr[f'{part}/phi'][self.get_part_mask(part)]
-        part_pt = self.arr[f'{part}/pt'][self.get_part_mask(part)]
-        cos_angles = np.cos(part_phi-self.var("Met_phi"))
-        close_mask = ak.argmax(cos_angles, axis=-1) == ak.local_index(cos_angles, axis=-1)
-        close_pt = self.flatten(part_pt[close_mask])
-
-        return np.sqrt(2*self.var("Met")*close_pt*(1 - self.flatten(cos_angles[close_mask])))
-    
+        mask, counts = self.get_part_mask(part)
+        return kernels.mwT(counts, self.flat(part, "phi")[1][mask], self.flat(part, "pt")[1][mask],
+                           self.var("Met"), self.var("Met_phi"))
+
     def flatten(self, arr):
         return ak.to_numpy(ak.flatten(arr))
     # arr_mod, scale_mod = ak.unzip(ak.cartesian([self.arr[name], self.scale]))
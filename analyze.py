@@ -6,10 +6,6 @@ import analysis_suite.commons.configs as configs
 import tarfile
 from pathlib import Path
 
-import ROOT
-ROOT.gROOT.SetBatch(True)
-ROOT.gROOT.ProcessLine( "gErrorIgnoreLevel = 1001;")
-
 jecTagsMC = {
     "2016": "Summer16_07Aug2017_V11_MC",
     "2017": "Fall17_17Nov2017_V32_MC",
@@ -104,6 +100,12 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--outfile", default="output.root")
     parser.add_argument("-v", "--verbose", default=-1)
     args = parser.parse_args()
+
+    # Only loaded once the arguments are good, it takes seconds
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    ROOT.gROOT.ProcessLine( "gErrorIgnoreLevel = 1001;")
+
     inputfile = args.infile if (env := os.getenv("INPUT")) is None else env
     outputfile = args.outfile if (env := os.getenv("OUTPUT")) is None else env
 
@@ -1,2 +1,11 @@
-from .info import BasicInfo, PlotInfo, FileInfo, GroupInfo
-from .makeSimpleHtml import writeHTML
+from importlib import import_module
+
+# Imported on first use, so loading a light module like configs does not
+# pull in numpy and pkg_resources
+_lazy = {"BasicInfo": ".info", "PlotInfo": ".info", "FileInfo": ".info",
+         "GroupInfo": ".info", "writeHTML": ".makeSimpleHtml"}
+
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(import_module(_lazy[name], __name__), name)
+    raise AttributeError(f'module {__name__} has no attribute {name}')
@@ -6,12 +6,10 @@ import sys
 import shutil
 import pkgutil
 import time
-import pandas as pd
 import logging
 from contextlib import contextmanager
 from pathlib import Path
 from collections import OrderedDict
-import analysis_suite.data.PlotGroups as PlotGroups
 import analysis_suite.data.plotInfo as plotInfo
 
 def first_time_actions():
@@ -24,7 +22,7 @@ def first_time_actions():
 def get_cli():
     parser = argparse.ArgumentParser(prog="main", description="Central script for running tools in the Analysis suite")
     parser.add_argument('tool', type=str, help="Tool to run",
-                    choices=['mva', 'plot', 'analyze', 'combine'])
+                    choices=['mva', 'plot', 'analyze', 'combine', 'pipeline'])
     ##################
     # Common options #
     ##################
@@ -33,7 +31,7 @@ def get_cli():
     parser.add_argument("-j", type=int, default=1, help="Number of cores")
     parser.add_argument("--log", type=str, default="ERROR",
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
-                        help="Set debug status (currently not used)")
+                        help="Logging level")
     parser.add_argument("-y", "--years", required=True,
                         type=lambda x : ["2016", "2017", "2018"] if x == "all" \
                                    else [i.strip() for i in x.split(',')],
@@ -41,20 +39,34 @@ def get_cli():
     parser.add_argument("-s", "--systs", default="Nominal",
                         type=lambda x : [i.strip() for i in x.split(',')],
                         help="Systematics to be used")
+    parser.add_argument("--format", default="root", choices=["root", "parquet", "arrow"],
+                        help="Format of the processed_/test_ files written")
+    parser.add_argument("--retries", type=int, default=1,
+                        help="Times a failed task is run again before giving up")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip tasks finished in an earlier run whose outputs are unchanged")
     histInfo = [ f.name for f in pkgutil.iter_modules(plotInfo.__path__) if not f.ispkg]
     parser.add_argument("-i", "--info", type=str, default="plotInfo_default",
                         choices=histInfo,
                             help="Name of file containing histogram Info")
-    if len(sys.argv) == 1:
-        pass
-    elif sys.argv[1] == "mva":
+    # pipeline takes the options of every tool
+    tool = sys.argv[1] if len(sys.argv) > 1 else None
+    if tool == "pipeline":
+        parser.add_argument("--stages", default="analyze,mva,plot,combine",
+                            type=lambda x : [i.strip() for i in x.split(',')],
+                            help="Tools to chain, in order")
+        parser.add_argument("--force", action="store_true",
+                            help="Rerun every task, even if its inputs did not change")
+    if tool in ["mva", "pipeline"]:
         parser.add_argument('-t', '--train', default="None",
                             choices=['None', 'DNN', 'TMVA', 'XGB', "CutBased"],
                             help="Run the training")
         parser.add_argument("-m", '--apply_model', action='store_true')
         parser.add_argument("--save", action='store_true')
         parser.add_argument("--plot", action='store_true')
-    elif sys.argv[1] == "plot":
+        parser.add_argument("--train_once", action='store_true',
+                            help="Train on Nominal only, then score every systematic with that model (in -j processes)")
+    if tool in ["plot", "pipeline"]:
         parser.add_argument("--trees", default="Analyzed",
                             type=lambda x : [i for i in x.split(',')])
         parser.add_argument("--no_mva", action="store_true")
@@ -73,14 +85,31 @@ def get_cli():
                             help="Ratio min ratio max (default 0.5 1.5)")
         parser.add_argument("--no_ratio", action="store_true",
                             help="Do not add ratio comparison")
-    elif sys.argv[1] == "combine":
+    if tool in ["analyze", "pipeline"]:
+        parser.add_argument("--single_pass", action="store_true",
+                            help="Read each group once and write all systematics in one job")
+        parser.add_argument("--dry_run", action="store_true",
+                            help="Only list the branches read for each variable")
+        parser.add_argument("--step_size", default=None,
+                            type=lambda x : int(x) if x.isdigit() else x,
+                            help="Stream the input in chunks of this many entries (or size, ie '100 MB')")
+        parser.add_argument("--backend", default="numpy", choices=["numba", "numpy"],
+                            help="Backend for the kinematic kernels, numba is faster but differs "
+                            "in float32 (see kernels)")
+        parser.add_argument("--no_cache", action="store_true",
+                            help="Recompute every column instead of using the column cache in workdir/YEAR/.cache")
+        parser.add_argument("--hash_inputs", action="store_true",
+                            help="Key the column cache on the input file contents instead of mtime")
+        parser.add_argument("--file_jobs", type=int, default=1,
+                            help="Processes used to read the input files of one job (needs -j 1)")
+        parser.add_argument("--profile", action="store_true",
+                            help="Write the time and memory used by each variable next to the processed files")
+    if tool in ["combine", "pipeline"]:
         parser.add_argument("-f", "--fit_var", required=True,
                             help="Variable used for fitting")
-    else:
-        pass
 
     # Combos
-    if len(sys.argv) > 1 and (sys.argv[1] == "plot" or sys.argv[1] == "combine"):
+    if tool in ["plot", "combine", "pipeline"]:
         parser.add_argument("-sig", "--signal", type=str, default='', required=True,
                             help="Name of the group to be made into the Signal")
 
@@ -101,27 +130,25 @@ def checkOrCreateDir(path):
 
 
 def getNormedHistos(infilename, file_info, plot_info, histName, year):
-    import awkward1 as ak
-    import uproot4 as uproot
     from analysis_suite.commons.histogram import Histogram
+    from analysis_suite.commons.tables import TableFile
 
     groupHists = dict()
     ak_col = plot_info.at(histName, "Column")
     cuts = cuts if (cuts := plot_info.at(histName, "Cuts")) else None
     cut = "*".join([f'({cut})' for cut in cuts]) if cuts else None
 
-    with uproot.open(infilename) as f:
+    with TableFile(infilename) as f:
         for group, members in file_info.group2MemberMap.items():
             groupHists[group] = Histogram(group, plot_info.get_binning(histName))
             for mem in members:
                 if mem not in f:
                     logging.warning(f'Could not find sample {mem} in file for year {year}')
                     continue
-                if ak_col not in f[mem]:
-                    print(f[mem][ak_col])
+                if ak_col not in f.columns(mem):
                     logging.error(f"Could not find variable {ak_col} in file for year {year}")
                     raise ValueError()
-                array = f[mem].arrays([ak_col, "scale_factor"], cut=cut)
+                array = f.arrays(mem, [ak_col, "scale_factor"], cut=cut)
                 groupHists[group].fill(array[ak_col], weight=array["scale_factor"], member=mem)
             groupHists[group].scale(plot_info.get_lumi(year)*1000)
 
@@ -147,20 +174,19 @@ def getGroupDict(groups, group_info):
 def get_list_systs(systs=["all"], tool="", **kwargs):
     allSysts = list()
 
-    if tool == "analyze":
-        import numpy as np
-        import uproot4 as uproot
+    # in a pipeline the later tools' inputs are not made yet, they get
+    # the systematics of the result files like analyze
+    if tool == "analyze" or kwargs.get("pipeline"):
+        from analysis_suite.commons.metadata import load_metadata
         for year in kwargs["years"]:
-            filename = Path(f'result_{year}.root')
-            with uproot.open(filename) as f:
-                syst_loc = list(filter(lambda x: "Systematics" in x, f.keys()))[0]
-                allSysts.append(set(np.unique([syst.member("fName") for syst in f[syst_loc]])))
-    elif tool == "mva":
-        name="processed_"
-        allSets = list()
+            allSysts.append(set(load_metadata(f'result_{year}.root').systematics))
+    elif tool in ["mva", "plot", "combine"]:
+        from analysis_suite.commons.tables import table_stem
+        name = "processed_" if tool == "mva" else "test_"
         for year in kwargs["years"]:
             d = kwargs["workdir"] / year
-            allSysts.append({syst.stem[len(name):] for syst in d.glob(f"{name}*.root")})
+            allSysts.append({stem[len(name):] for syst in d.glob(f"{name}*")
+                             if (stem := table_stem(syst)) is not None})
 
     if systs == ["all"]:
         return set.intersection(*allSysts)
@@ -169,12 +195,9 @@ def get_list_systs(systs=["all"], tool="", **kwargs):
                 if clean_syst(syst) in systs]
 
 def get_trees(years):
-    import uproot4 as uproot
+    from analysis_suite.commons.metadata import load_metadata
     for year in years:
-        filename = Path(f'result_{year}.root')
-        with uproot.open(filename) as f:
-            group = [key.strip(";1") for key in f.keys() if "/" not in key][0]
-            return [key.strip(";1") for key, val in f[group].items() if "TTree" in repr(val)]
+        return load_metadata(f'result_{year}.root').trees
 
 def clean_syst(syst):
     return syst.replace("_down","").replace("_up","")
@@ -196,11 +219,14 @@ def make_plot_paths(path):
     checkOrCreateDir(path / "plots")
     checkOrCreateDir(path / "logs")
 
-def setup_pandas(use_vars, all_vars):
+def setup_pandas(use_vars, all_vars, types=None):
+    """Empty DataFrame with the dtype of each Variable, and of the other
+    columns from `types` (column name to dtype)"""
+    import pandas as pd
     df_set = pd.DataFrame(columns = all_vars)
-    for key, func in use_vars.items():
-        df_set[key] = df_set[key].astype(func.getType())
-    return df_set
+    types = dict(types) if types is not None else dict()
+    types.update({key: func.getType() for key, func in use_vars.items()})
+    return df_set.astype({key: dtype for key, dtype in types.items() if key in all_vars})
 
 def get_shape_systs():
     from analysis_suite.data.inputs import systematics
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+.. module:: files
+   :synopsis: Atomic writes and content hashes of the files kept by the suite
+"""
+import os
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """**Open a temporary file that replaces `path` once written**
+
+    Other jobs reading `path` see either the old or the new file, never
+    part of one. If the with block raises, the temporary file is deleted
+    and `path` left as it was.
+
+    Args:
+      path(Path): File to write
+      mode(str): "w" or "wb"
+    """
+    path = Path(path)
+    tmpfile = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmpfile, mode) as f:
+            yield f
+        tmpfile.replace(path)
+    finally:
+        if tmpfile.exists():
+            tmpfile.unlink()
+
+def file_sha1(path):
+    """SHA1 of the contents of a file, read in 1 MB blocks"""
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
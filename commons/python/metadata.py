@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+.. module:: metadata
+   :synopsis: MetaData, Systematics and sumweight of result files, parsed once
+
+The metadata of a result file is kept in a sidecar manifest
+(result_YEAR.meta.json) so setting up jobs does not need to open the
+ROOT file. It is made lazily on first use, or right after merging with
+
+    python3 -m analysis_suite.commons.metadata result_2018.root
+"""
+import sys
+import json
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+from .files import atomic_write
+
+
+@dataclass
+class GroupMeta:
+    """Information about one group (sample) of a result file"""
+    name: str
+    metadata: dict = field(default_factory=dict)
+    systematics: list = field(default_factory=list)
+    sumw: float = 0.
+    trees: dict = field(default_factory=dict)
+
+    @property
+    def xsec(self):
+        return float(self.metadata["Xsec"])
+
+    @property
+    def year(self):
+        return self.metadata.get("Year")
+
+    @property
+    def analysis(self):
+        return self.metadata.get("Analysis")
+
+    @property
+    def isData(self):
+        return self.name == "data"
+
+    @property
+    def entries(self):
+        return {tree: info["entries"] for tree, info in self.trees.items()}
+
+    @classmethod
+    def read(cls, f, group):
+        """Parse the group from an open uproot file"""
+        metadata = {item.member("fName"): item.member("fTitle") for item in f[group]["MetaData"]}
+        systNames = [syst.member("fName") for syst in f[group]["Systematics"]]
+        trees = dict()
+        for key, obj in f[group].items():
+            if "TTree" in repr(obj):
+                trees[key.split(";")[0]] = {"entries": int(obj.num_entries),
+                                            "bytes": int(obj.member("fZipBytes")),
+                                            "uncompressed_bytes": int(obj.member("fTotBytes"))}
+        return cls(group, metadata, list(OrderedDict.fromkeys(systNames)),
+                   float(sum(f[group]["sumweight"].values())), trees)
+
+
+@dataclass
+class FileMeta:
+    """**Information about every group of a result file**
+
+    Can be saved as a small JSON manifest next to the file (see
+    `load_metadata`) so it is only parsed from the ROOT file once.
+    """
+    version = 2
+    path: str
+    mtime: int = 0
+    size: int = 0
+    groups: dict = field(default_factory=OrderedDict)
+
+    @property
+    def systematics(self):
+        """Systematic names in the order of the weight/PassEvent columns"""
+        return next(iter(self.groups.values())).systematics if self.groups else []
+
+    @property
+    def trees(self):
+        """Trees in the file, in the order of the first group"""
+        return list(next(iter(self.groups.values())).trees) if self.groups else []
+
+    def __getitem__(self, group):
+        return self.groups[group]
+
+    def __contains__(self, group):
+        return group in self.groups
+
+    @classmethod
+    def read(cls, f, path):
+        """Parse every group of an open uproot file"""
+        stat = Path(path).stat()
+        groups = [key.split(";")[0] for key in f.keys() if "/" not in key]
+        return cls(str(path), stat.st_mtime_ns, stat.st_size,
+                   OrderedDict((group, GroupMeta.read(f, group)) for group in groups))
+
+    def is_current(self, path):
+        stat = Path(path).stat()
+        return (self.mtime, self.size) == (stat.st_mtime_ns, stat.st_size)
+
+    def save(self, outfile):
+        outfile = Path(outfile)
+        # other jobs may be reading it
+        with atomic_write(outfile) as f:
+            json.dump({"version": self.version, **asdict(self)}, f, indent=1)
+
+    @classmethod
+    def load(cls, infile):
+        with open(infile) as f:
+            info = json.load(f)
+        if info.pop("version", 1) != cls.version:
+            raise ValueError(f'{infile} is an old version')
+        info["groups"] = OrderedDict((name, GroupMeta(**group))
+                                     for name, group in info["groups"].items())
+        return cls(**info)
+
+
+def index_path(path):
+    """Sidecar manifest of a result file, ie result_2018.meta.json"""
+    path = Path(path)
+    return path.with_name(f'{path.stem}.meta.json')
+
+
+_loaded = dict()
+
+def load_metadata(path, f=None):
+    """**Metadata of a result file, parsed at most once**
+
+    Uses the sidecar manifest if it matches the file's mtime and size,
+    otherwise parses the file (`f` if already open) and writes the
+    manifest. Results are also kept for the life of the process.
+
+    Args:
+      path(Path): Result file
+      f(uproot file, optional): The file, if already open
+
+    Returns:
+      FileMeta: metadata of every group
+    """
+    path = Path(path)
+    key = str(path.resolve())
+    if key in _loaded and _loaded[key].is_current(path):
+        return _loaded[key]
+
+    index = index_path(path)
+    meta = None
+    if index.exists():
+        try:
+            meta = FileMeta.load(index)
+        except (ValueError, KeyError, TypeError):
+            logging.warning(f'Could not read manifest {index}, remaking it')
+    if meta is None or not meta.is_current(path):
+        if f is None:
+            import uproot4 as uproot
+            with uproot.open(path) as f:
+                meta = FileMeta.read(f, path)
+        else:
+            meta = FileMeta.read(f, path)
+        try:
+            meta.save(index)
+        except OSError:
+            logging.info(f'Could not write manifest {index}')
+    _loaded[key] = meta
+    return meta
+
+
+def share_metadata(metas):
+    """Install metadata parsed in another process, ie in the workers of a pool"""
+    for meta in metas:
+        _loaded[str(Path(meta.path).resolve())] = meta
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        meta = load_metadata(filename)
+        print(f'{index_path(filename)}: {len(meta.groups)} groups, '
+              f'{len(meta.systematics)} systematics, trees {", ".join(meta.trees)}')
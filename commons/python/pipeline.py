@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+.. module:: pipeline
+   :synopsis: Runs analyze, mva, plot and combine as one graph of tasks, redoing only what changed
+"""
+import json
+import time
+import queue
+import hashlib
+import logging
+import argparse
+import multiprocessing as mp
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from importlib import import_module
+from pathlib import Path
+
+from .files import atomic_write, file_sha1
+from .scheduler import _init_worker, _run_task, task_name, describe, format_time
+from .telemetry import Telemetry, measure
+
+stages = OrderedDict([
+    ("analyze", "analysis_suite.Variable_Creator.job_main"),
+    ("mva", "analysis_suite.BDT_utilities.job_main"),
+    ("plot", "analysis_suite.Plotting.job_main"),
+    ("combine", "analysis_suite.Combine.job_main"),
+])
+
+# Options changing what a stage's tasks make that are not in their arguments
+stage_options = {
+    "analyze": [],
+    "mva": [],
+    "plot": ["info", "trees", "no_mva", "drawStyle", "logy", "stack_signal",
+             "ratio_range", "no_ratio"],
+    "combine": ["info"],
+}
+
+# Config modules whose contents change what a stage's tasks make (Variables,
+# MVA inputs and cuts, groups, histograms), formatted with the options
+stage_configs = {
+    "analyze": ["analysis_suite.data.inputs"],
+    "mva": ["analysis_suite.data.inputs", "analysis_suite.data.PlotGroups"],
+    "plot": ["analysis_suite.data.inputs", "analysis_suite.data.PlotGroups",
+             "analysis_suite.data.plotInfo.{info}"],
+    "combine": ["analysis_suite.data.inputs", "analysis_suite.data.PlotGroups",
+                "analysis_suite.data.plotInfo.{info}"],
+}
+
+def _init_workers(modules):
+    for module, shared in modules:
+        _init_worker(module, shared)
+
+
+@dataclass
+class Task:
+    """One call to a tool's `run`, with the files it reads and writes"""
+    stage: str
+    args: tuple
+    inputs: list
+    outputs: list
+    deps: set = field(default_factory=set)
+
+    @property
+    def name(self):
+        return f'{self.stage}:{task_name(self.args)}'
+
+
+class Pipeline:
+    """**Chain the tools as a graph of tasks**
+
+    Each tool's `setup` gives its tasks, and its `task_inputs` and
+    `task_outputs` the files each task reads and writes: a task depends
+    on the tasks making its inputs (ie plot of test_JES_up on the mva
+    task of JES_up, on the analyze task of JES_up). Tasks are run as
+    soon as their own inputs are made, so different years and
+    systematics move through the chain independently, all in one pool.
+    A stage's `cleanup` is run once all of its tasks are done.
+
+    Make-style, a task is only run if the content hash of one of its
+    inputs, its arguments, the options of its stage (see
+    `stage_options`) or the config modules it uses (see
+    `stage_configs`) changed since it last succeeded, or one of its
+    outputs was changed or removed. Hashes are kept in
+    `workdir/.pipeline.json`, with the hash of each file stored by
+    size and mtime so unchanged files are not read again.
+
+    Args:
+      cli_args(Namespace): Options of every tool, see `get_cli`
+    """
+    def __init__(self, cli_args):
+        self.cli_args = cli_args
+        self.force = cli_args.force
+        unknown = set(cli_args.stages) - set(stages)
+        if unknown:
+            raise ValueError(f'Unknown stages {", ".join(unknown)}, use {", ".join(stages)}')
+        self.stages = [stage for stage in stages if stage in cli_args.stages]
+        self.modules = {stage: import_module(stages[stage]) for stage in self.stages}
+        self.configs = dict()
+        for stage in self.stages:
+            options = {key: getattr(cli_args, key, None) for key in stage_options[stage]}
+            configs = [name.format(**vars(cli_args)) for name in stage_configs[stage]]
+            options["configs"] = {name: file_sha1(import_module(name).__file__) for name in configs}
+            self.configs[stage] = describe(options)
+
+        self.state_file = Path(cli_args.workdir) / ".pipeline.json"
+        self.state = {"tasks": dict(), "files": dict()}
+        if self.state_file.exists():
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+        self.tasks = self._build()
+        self.cleaned = set()
+        self.telemetry = Telemetry()
+
+    def stage_args(self, stage):
+        """Options as seen by a tool run on its own"""
+        return argparse.Namespace(**{**vars(self.cli_args), "tool": stage, "pipeline": True})
+
+    def _build(self):
+        tasks = list()
+        for stage in self.stages:
+            module = self.modules[stage]
+            inputs = getattr(module, "task_inputs", None)
+            outputs = getattr(module, "task_outputs", lambda *args: [])
+            earlier = set(range(len(tasks)))
+            for args in module.setup(self.stage_args(stage)):
+                task = Task(stage, args, [], list(map(Path, outputs(*args))))
+                if inputs is None:
+                    # nothing declared, wait for every earlier stage
+                    task.deps = set(earlier)
+                else:
+                    task.inputs = list(map(Path, inputs(*args)))
+                tasks.append(task)
+
+        makers = {str(out.resolve()): idx for idx, task in enumerate(tasks)
+                  for out in task.outputs}
+        for idx, task in enumerate(tasks):
+            task.deps |= {makers[path] for inp in task.inputs
+                          if (path := str(inp.resolve())) in makers and makers[path] != idx}
+        return tasks
+
+    def file_hash(self, path):
+        """Hash of a file, or of every file of a directory, None if missing"""
+        path = Path(path)
+        if not path.exists():
+            return None
+        files = sorted(sub for sub in path.rglob("*") if sub.is_file()) if path.is_dir() else [path]
+        known = self.state["files"]
+        sha = hashlib.sha1()
+        for sub in files:
+            stat = sub.stat()
+            stamp = [stat.st_size, stat.st_mtime_ns]
+            entry = known.get(str(sub))
+            if entry is None or entry[:2] != stamp:
+                entry = known[str(sub)] = stamp + [file_sha1(sub)]
+            sha.update(f'{sub.relative_to(path)}:{entry[2]}\n'.encode())
+        return sha.hexdigest()
+
+    def task_key(self, task):
+        sha = hashlib.sha1()
+        sha.update(json.dumps([task.stage, describe(task.args), self.configs[task.stage]],
+                              sort_keys=True).encode())
+        for inp in task.inputs:
+            sha.update(f'{inp}:{self.file_hash(inp)}\n'.encode())
+        return sha.hexdigest()
+
+    def is_current(self, task, key):
+        record = self.state["tasks"].get(task.name)
+        if self.force or record is None or record["key"] != key:
+            return False
+        return all(self.file_hash(out) == record["outputs"].get(str(out))
+                   for out in task.outputs)
+
+    def save(self):
+        # an interrupted run keeps the last state
+        with atomic_write(self.state_file) as f:
+            json.dump(self.state, f)
+
+    def run(self, nprocs=1):
+        """**Run the tasks whose inputs changed, in dependency order**
+
+        Args:
+          nprocs(int): Number of processes, shared by every stage
+
+        Returns:
+          list: names of the tasks that failed, or were not run because
+            a task they depend on failed
+        """
+        results = queue.Queue()
+        pool = None
+        if nprocs == 1:
+            for module in self.modules.values():
+                if hasattr(module, "preload"):
+                    module.preload()
+        else:
+            shared = [(module.__name__, getattr(module, "shared", None))
+                      for module in self.modules.values()]
+            pool = mp.Pool(nprocs, _init_workers, (shared,))
+
+        waiting = set(range(len(self.tasks)))
+        running, done, failed, ran = set(), set(), set(), set()
+        keys = dict()
+        start = time.perf_counter()
+        try:
+            while waiting or running:
+                # skipped tasks free their dependents right away
+                while ready := sorted(idx for idx in waiting
+                                      if self.tasks[idx].deps <= done | failed):
+                    for idx in ready:
+                        task = self.tasks[idx]
+                        waiting.remove(idx)
+                        if task.deps & failed:
+                            logging.error(f'Not running {task.name}, a task it needs failed')
+                            failed.add(idx)
+                            continue
+                        keys[idx] = self.task_key(task)
+                        if self.is_current(task, keys[idx]):
+                            done.add(idx)
+                            continue
+                        running.add(idx)
+                        self._submit(pool, results, idx)
+                self._finish_stages(waiting | running, failed, ran)
+                if not running:
+                    if waiting:
+                        raise RuntimeError("Tasks depend on each other: "
+                                           + ", ".join(self.tasks[idx].name for idx in waiting))
+                    continue
+
+                idx, seconds, error, stats = results.get()
+                task = self.tasks[idx]
+                self.telemetry.add(task.stage, task.name, stats)
+                running.remove(idx)
+                ran.add(idx)
+                if error is None:
+                    done.add(idx)
+                    self.state["tasks"][task.name] = {
+                        "key": keys[idx],
+                        "outputs": {str(out): self.file_hash(out) for out in task.outputs}}
+                    self.save()
+                else:
+                    failed.add(idx)
+                    logging.error(f'Task {task.name} failed:\n{error}')
+                print(f'[{len(done | failed)}/{len(self.tasks)}] {task.name} '
+                      f'{"failed" if error else "done"} in {seconds:.1f}s, '
+                      f'elapsed {format_time(time.perf_counter() - start)}', flush=True)
+            self._finish_stages(set(), failed, ran)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self.save()
+
+        print(f'{len(ran)} tasks run, {len(done - ran)} up to date, {len(failed)} failed')
+        self.telemetry.report(self.cli_args.workdir, "pipeline")
+        return [self.tasks[idx].name for idx in sorted(failed)]
+
+    def _submit(self, pool, results, idx):
+        task = self.tasks[idx]
+        job = (idx, self.modules[task.stage].run, task.args)
+        if pool is None:
+            results.put(_run_task(job))
+        else:
+            pool.apply_async(_run_task, (job,), callback=results.put,
+                             error_callback=lambda error: results.put((idx, 0., repr(error), dict())))
+
+    def _finish_stages(self, pending, failed, ran):
+        """Run the cleanup of each stage once none of its tasks are left,
+        if one of them was run and none failed"""
+        busy = {self.tasks[idx].stage for idx in pending}
+        for stage in self.stages:
+            if stage in busy or stage in self.cleaned:
+                continue
+            self.cleaned.add(stage)
+            indices = {idx for idx, task in enumerate(self.tasks) if task.stage == stage}
+            if indices & failed:
+                logging.error(f'Not running the cleanup of {stage}, some of its tasks failed')
+            elif indices & ran or self.force:
+                with measure() as stats:
+                    self.modules[stage].cleanup(self.stage_args(stage))
+                self.telemetry.add("cleanup", stage, stats)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+.. module:: scheduler
+   :synopsis: Runs the tasks of a tool, largest first, with progress, ETA and a journal
+"""
+import json
+import time
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from importlib import import_module
+from pathlib import Path
+
+from .telemetry import Telemetry, measure
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+def task_name(args):
+    """Readable key of a task from its simple arguments"""
+    parts = list()
+    for arg in args:
+        if isinstance(arg, (str, Path, int, float)):
+            parts.append(str(arg))
+        elif isinstance(arg, list) and all(isinstance(item, str) for item in arg):
+            parts.append(",".join(arg))
+    return "|".join(parts)
+
+def describe(arg):
+    """JSON friendly summary of a task argument"""
+    if isinstance(arg, (str, int, float, bool)) or arg is None:
+        return arg
+    elif isinstance(arg, Path):
+        return str(arg)
+    elif isinstance(arg, (set, frozenset)):
+        # in a fixed order, sets iterate in hash seed order
+        return sorted((describe(item) for item in arg), key=json.dumps)
+    elif isinstance(arg, (list, tuple)):
+        return [describe(item) for item in arg]
+    elif isinstance(arg, dict):
+        return {str(key): describe(val) for key, val in arg.items()}
+    return type(arg).__name__
+
+def _init_worker(module, shared):
+    """Pool initializer: install the read-only config shared by the tasks
+    of the tool and import its heavy libraries, once per worker"""
+    job_main = import_module(module)
+    if shared is not None:
+        job_main.shared.update(shared)
+    if hasattr(job_main, "preload"):
+        job_main.preload()
+
+def _run_task(task):
+    """Run one task, returning the error instead of raising so the
+    other tasks of the pool carry on, and its telemetry"""
+    idx, func, args = task
+    with measure() as stats:
+        try:
+            func(*args)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+    return idx, stats["wall"], error, stats
+
+def _pool_results(pool, tasks):
+    """Results of the tasks run in `pool`, as they finish. When a worker
+    dies (killed, out of memory, crash in a C extension) the pool breaks:
+    the tasks left are returned as failed instead of waiting forever"""
+    futures = {pool.submit(_run_task, task): task[0] for task in tasks}
+    for future in as_completed(futures):
+        try:
+            yield future.result()
+        except BrokenProcessPool as error:
+            yield futures[future], 0., f'Worker process died: {error}', dict()
+
+
+class Journal:
+    """**Record of every task run in a workdir**
+
+    One JSON line per attempt in `workdir/.journal_<tool>.jsonl` with the
+    task, its arguments, status, duration, error and the size of each
+    output, so a later run can tell which tasks are complete.
+    """
+    def __init__(self, workdir, tool):
+        self.path = Path(workdir) / f'.journal_{tool}.jsonl'
+        self.last = dict()
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.last[record["task"]] = record
+
+    def record(self, name, args, status, duration, outputs=(), error=None, attempt=1):
+        record = {"task": name, "args": describe(args), "status": status,
+                  "attempt": attempt, "duration": duration, "time": time.time(),
+                  "outputs": {str(out): out.stat().st_size for out in map(Path, outputs)
+                              if out.exists()},
+                  "error": error}
+        self.last[name] = record
+        try:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError:
+            logging.warning(f'Could not write to task journal {self.path}')
+
+    def is_complete(self, name, outputs):
+        """Task finished before and its outputs are still there, unchanged"""
+        record = self.last.get(name)
+        if record is None or record["status"] != "done":
+            return False
+        sizes = record["outputs"]
+        for out in map(Path, outputs):
+            if not out.exists() or sizes.get(str(out)) != out.stat().st_size:
+                return False
+        return True
+
+
+class Scheduler:
+    """**Run `job_main.run` over an argList, longest tasks first**
+
+    The cost of each task is estimated from the `task_cost` function of
+    the job_main (ie bytes of input, same arguments as `run`), and from
+    the time the task took in earlier runs, stored in
+    `workdir/.timings.json`. Estimates are converted to seconds with the
+    rate seen on tasks that have both. Tasks are then dispatched largest
+    first one at a time, so a long task never starts last.
+
+    Failing tasks do not stop the others: they are retried up to
+    `retries` times once the rest are done, and reported at the end. A
+    worker dying fails the tasks not yet finished, which are retried in
+    a new pool.
+    Every attempt is written to the task journal (see `Journal`); with
+    `resume`, tasks the journal has as done, whose outputs (from the
+    job_main's `task_outputs`) are unchanged, are skipped.
+
+    Config used by every task (PlotInfo, group maps, file metadata...)
+    is kept by the job_main in its module level `shared` dict rather
+    than in each task's arguments. It is sent to each worker once, when
+    the pool starts, along with a call to the job_main's `preload`.
+
+    Args:
+      job_main(module): Tool module with `run` and optionally `task_cost`,
+        `task_outputs`, `shared` and `preload`
+      tool(str): Name of the tool, key of its timings
+      workdir(Path): Directory where the timings and journal are kept
+      retries(int): Number of times a failed task is run again
+      resume(bool): Skip the tasks completed in an earlier run
+    """
+    def __init__(self, job_main, tool, workdir, retries=1, resume=False):
+        self.func = job_main.run
+        self.module = job_main.__name__
+        self.shared = getattr(job_main, "shared", None)
+        self.preload = getattr(job_main, "preload", None)
+        self.estimator = getattr(job_main, "task_cost", None)
+        self.outputs = getattr(job_main, "task_outputs", lambda *args: [])
+        self.retries = retries
+        self.resume = resume
+        self.journal = Journal(workdir, tool)
+        self.telemetry = Telemetry()
+        self.tool = tool
+        self.timing_file = Path(workdir) / ".timings.json"
+        self.timings = dict()
+        if self.timing_file.exists():
+            with open(self.timing_file) as f:
+                self.timings = json.load(f)
+
+    def costs(self, argList):
+        """Estimated seconds (or relative cost if nothing has been timed) of each task"""
+        history = self.timings.get(self.tool, dict())
+        names = [task_name(args) for args in argList]
+        estimates = [self._estimate(args) for args in argList]
+        rates = sorted(history[name]/estimate for name, estimate in zip(names, estimates)
+                       if name in history and estimate)
+        rate = rates[len(rates)//2] if rates else 1.
+        default = (sum(history.values())/len(history)) if history else 1.
+
+        costs = list()
+        for name, estimate in zip(names, estimates):
+            if name in history:
+                costs.append(history[name])
+            elif estimate is not None:
+                costs.append(estimate*rate)
+            else:
+                costs.append(default)
+        return costs
+
+    def _estimate(self, args):
+        if self.estimator is None:
+            return None
+        try:
+            return self.estimator(*args)
+        except (OSError, KeyError, ValueError) as error:
+            logging.debug(f'No cost estimate for {task_name(args)}: {error}')
+            return None
+
+    def run(self, argList, nprocs=1):
+        """**Run every task, printing progress and an ETA**
+
+        Args:
+          argList(list): Arguments of each call to `run`
+          nprocs(int): Number of processes
+
+        Returns:
+          list: names of the tasks that still failed after the retries
+        """
+        todo = list(range(len(argList)))
+        if self.resume:
+            todo = [idx for idx in todo
+                    if not self.journal.is_complete(task_name(argList[idx]),
+                                                    self.outputs(*argList[idx]))]
+            print(f'Resuming: {len(argList) - len(todo)} of {len(argList)} tasks already done')
+
+        costs = self.costs(argList)
+        for attempt in range(1, self.retries + 2):
+            if not todo:
+                break
+            elif attempt > 1:
+                print(f'Retrying {len(todo)} failed tasks (attempt {attempt})')
+            todo = self._run_tasks(argList, sorted(todo, key=lambda i: -costs[i]),
+                                   costs, nprocs, attempt)
+
+        failed = [task_name(argList[idx]) for idx in todo]
+        for idx in todo:
+            logging.error(f'Task {task_name(argList[idx])} failed:\n'
+                          f'{self.journal.last[task_name(argList[idx])]["error"]}')
+        return failed
+
+    def _run_tasks(self, argList, order, costs, nprocs, attempt):
+        """Run the tasks in `order`, returning the indices of those that failed"""
+        tasks = [(idx, self.func, argList[idx]) for idx in order]
+        total = sum(costs[idx] for idx in order)
+        done_cost = 0.
+        failed = list()
+        start = time.perf_counter()
+        history = self.timings.setdefault(self.tool, dict())
+
+        # a lone task runs here, free to start its own processes
+        if nprocs == 1 or len(tasks) == 1:
+            if self.preload is not None:
+                self.preload()
+            results = map(_run_task, tasks)
+        else:
+            pool = ProcessPoolExecutor(nprocs, initializer=_init_worker,
+                                       initargs=(self.module, self.shared))
+            results = _pool_results(pool, tasks)
+        try:
+            for ndone, (idx, seconds, error, stats) in enumerate(results, 1):
+                name = task_name(argList[idx])
+                self.telemetry.add(self.tool, name, stats)
+                if error is None:
+                    history[name] = seconds
+                    status = "done"
+                else:
+                    failed.append(idx)
+                    status = "failed"
+                self.journal.record(name, argList[idx], status, seconds,
+                                    self.outputs(*argList[idx]), error, attempt)
+                done_cost += costs[idx]
+                elapsed = time.perf_counter() - start
+                eta = elapsed*(total - done_cost)/done_cost if done_cost else 0.
+                print(f'[{ndone}/{len(tasks)}] {name} {status} in {seconds:.1f}s, '
+                      f'elapsed {format_time(elapsed)}, ETA {format_time(eta)}', flush=True)
+        finally:
+            if nprocs != 1 and len(tasks) != 1:
+                pool.shutdown()
+            self.save()
+        return failed
+
+    def save(self):
+        try:
+            with open(self.timing_file, 'w') as f:
+                json.dump(self.timings, f, indent=1)
+        except OSError:
+            logging.warning(f'Could not save task timings to {self.timing_file}')
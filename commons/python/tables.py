@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+.. module:: tables
+   :synopsis: Read and write the processed_*/test_* tables as ROOT, Parquet or Arrow
+"""
+import re
+import shutil
+import numpy as np
+from pathlib import Path
+
+from .telemetry import add_events
+
+formats = {"root": ".root", "parquet": ".parquet", "arrow": ".arrow"}
+
+def get_format(path):
+    for fmt, suffix in formats.items():
+        if Path(path).suffix == suffix:
+            return fmt
+    raise ValueError(f'{path} is not a known table format')
+
+def table_path(base, fmt="root"):
+    """Path of a table file from its name without suffix"""
+    return Path(f'{base}{formats[fmt]}')
+
+def find_table(base, fmt="root"):
+    """Existing table file for a name without suffix, in the `fmt` format
+    if there is one, so a leftover file in another format never hides it,
+    otherwise in whichever format exists (`fmt` if none exists yet)"""
+    for other in [fmt] + [other for other in formats if other != fmt]:
+        if (path := table_path(base, other)).exists():
+            return path
+    return table_path(base, fmt)
+
+def table_size(path):
+    """Bytes on disk of a table file (or directory of per-group files)"""
+    path = Path(path)
+    if path.is_dir():
+        return sum(sub.stat().st_size for sub in path.iterdir())
+    return path.stat().st_size
+
+def table_stem(path):
+    """Name of a table file without the format suffix, None if not a table"""
+    path = Path(path)
+    return path.stem if path.suffix in formats.values() else None
+
+
+class TableWriter:
+    """**Write DataFrames as named trees/tables**
+
+    ROOT files hold one tree per name. Parquet and Arrow outputs are
+    directories holding one `<name>.parquet` or `<name>.arrow` file per
+    name. Writing the same name again appends to it.
+
+    Args:
+      outfile(Path): File to write, the suffix sets the format
+      dtypes(dict, optional): column name to numpy type to write as
+      atomic(bool, optional): Write to a temporary file and only replace
+        outfile once closed without error, so a failed write keeps the
+        old file
+    """
+    def __init__(self, outfile, dtypes=None, atomic=False):
+        self.outfile = Path(outfile)
+        self.fmt = get_format(self.outfile)
+        self.dtypes = dtypes
+        self.atomic = atomic
+        self.path = self.outfile.parent / f'tmp_{self.outfile.name}' if atomic else self.outfile
+        self._writers = dict()
+        if self.fmt == "root":
+            import uproot as upwrite
+            self._file = upwrite.recreate(self.path)
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            for old in self.path.glob(f'*{formats[self.fmt]}'):
+                old.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.close(keep=exc_type is None)
+
+    def write(self, name, df):
+        dtypes = self.dtypes if self.dtypes is not None else df.dtypes.to_dict()
+        columns = {key: df[key].to_numpy(dtype=dtype) for key, dtype in dtypes.items()}
+        if self.fmt == "root":
+            self._write_root(name, columns, dtypes)
+        else:
+            self._write_arrow(name, columns)
+
+    def _write_root(self, name, columns, dtypes):
+        import uproot as upwrite
+        if name not in self._writers:
+            self._file[name] = upwrite.newtree(dtypes)
+            self._writers[name] = self._file[name]
+        self._writers[name].extend(columns)
+
+    def _write_arrow(self, name, columns):
+        import pyarrow as pa
+        table = pa.table(columns)
+        if name not in self._writers:
+            filename = self.path / f'{name}{formats[self.fmt]}'
+            if self.fmt == "parquet":
+                import pyarrow.parquet as pq
+                self._writers[name] = pq.ParquetWriter(filename, table.schema)
+            else:
+                self._writers[name] = pa.ipc.new_file(filename, table.schema)
+        self._writers[name].write_table(table)
+
+    def close(self, keep=True):
+        """Close the file, with `atomic` replacing outfile by it if `keep`,
+        otherwise deleting it and leaving outfile as it was"""
+        if self.fmt == "root":
+            self._file.close()
+        else:
+            for writer in self._writers.values():
+                writer.close()
+        self._writers = dict()
+        if not self.atomic or not self.path.exists():
+            return
+        elif not keep:
+            if self.path.is_dir():
+                shutil.rmtree(self.path)
+            else:
+                self.path.unlink()
+            return
+        if self.outfile.is_dir():
+            shutil.rmtree(self.outfile)
+        self.path.replace(self.outfile)
+
+
+class TableFile:
+    """**Read processed_*/test_* files in any format**
+
+    Follows the small part of the uproot interface used in the suite:
+    `name in f`, `f.keys()` and `f.arrays(name, columns, cut)`. Parquet
+    and Arrow only load the requested columns, with Arrow files memory
+    mapped.
+
+    Args:
+      path(Path): File to read
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fmt = get_format(self.path)
+        if self.fmt == "root":
+            import uproot4 as uproot
+            self._file = uproot.open(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fmt == "root":
+            self._file.close()
+
+    def keys(self):
+        if self.fmt == "root":
+            return [key.split(";")[0] for key in self._file.keys() if "/" not in key]
+        return [path.stem for path in sorted(self.path.glob(f'*{formats[self.fmt]}'))]
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def columns(self, name):
+        if self.fmt == "root":
+            return list(self._file[name].keys())
+        return self._schema(name).names
+
+    def arrays(self, name, columns=None, cut=None):
+        """**Read a table as a pandas DataFrame**
+
+        Args:
+          name(string): Tree/table to read
+          columns(list, optional): Columns to read, all if None
+          cut(string, optional): Python expression on the columns used to
+            select rows, ie `(l1Pt>25)*(l2Pt>20)`
+        """
+        if self.fmt == "root":
+            df = self._file[name].arrays(columns, cut=cut, library="pd")
+            add_events(len(df))
+            return df
+
+        read_columns = columns
+        if columns is not None and cut is not None:
+            names = set(re.findall(r'[A-Za-z_]\w*', cut)) & set(self.columns(name))
+            read_columns = list(columns) + list(names - set(columns))
+        df = self._read(name, read_columns).to_pandas()
+        if cut is not None:
+            mask = eval(cut, {"np": np}, {key: df[key].to_numpy() for key in df.columns})
+            df = df[np.asarray(mask, dtype=bool)]
+            if columns is not None:
+                df = df[list(columns)]
+        add_events(len(df))
+        return df
+
+    def _schema(self, name):
+        """Schema of a table, read from the file footer without loading any column"""
+        import pyarrow as pa
+        filename = self.path / f'{name}{formats[self.fmt]}'
+        if self.fmt == "parquet":
+            import pyarrow.parquet as pq
+            return pq.read_schema(filename, memory_map=True)
+        return pa.ipc.open_file(pa.memory_map(str(filename))).schema
+
+    def _read(self, name, columns=None):
+        import pyarrow as pa
+        filename = self.path / f'{name}{formats[self.fmt]}'
+        if self.fmt == "parquet":
+            import pyarrow.parquet as pq
+            return pq.read_table(filename, columns=columns, memory_map=True)
+        table = pa.ipc.open_file(pa.memory_map(str(filename))).read_all()
+        return table if columns is None else table.select(columns)
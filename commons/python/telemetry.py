@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+.. module:: telemetry
+   :synopsis: Time, memory, I/O and events of each task, summed per stage
+"""
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+from pathlib import Path
+
+_events = 0
+_children = list()
+
+def add_events(nevents):
+    """Count events processed by the current task (rows read from the
+    processed_/test_ tables, or written by analyze)"""
+    global _events
+    _events += int(nevents)
+
+def add_child(stats):
+    """Add the measurement of work done in a child process (see
+    `measured`) to the current one"""
+    _children.append(stats)
+
+def measured(func, *args):
+    """**Call `func(*args)` measuring it, for use in a child process**
+
+    Returns:
+      tuple: result of func and its stats, to give to `add_child` in
+        the parent
+    """
+    with measure() as stats:
+        result = func(*args)
+    return result, stats
+
+def _io_bytes():
+    """Bytes read and written by this process so far (Linux only)"""
+    try:
+        with open("/proc/self/io") as f:
+            info = dict(line.split(":") for line in f)
+        return int(info["rchar"]), int(info["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def _reset_peak_rss():
+    """Restart the peak RSS count of this process, False if not possible"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    """Peak resident memory in bytes, since the last reset if supported"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    # kB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak*1024
+
+def _cpu_time():
+    """CPU seconds of this process and of its finished children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+@contextmanager
+def measure():
+    """**Measure the code in the with block**
+
+    Yields a dict filled on exit with the wall and CPU time (including
+    child processes), peak RSS, bytes read and written, events counted
+    with `add_events` and events per second. The peak RSS is that of
+    the block where the kernel allows resetting it, otherwise of the
+    whole process.
+
+    Child processes started in the block (ie the file_jobs pool) only
+    count if their measurements are given to `add_child`: their bytes
+    and events are added, and the largest peak RSS of each child to
+    that of this process, an upper bound as they may not peak together.
+    """
+    global _events
+    stats = {"pid": os.getpid()}
+    _events = 0
+    del _children[:]
+    _reset_peak_rss()
+    read, written = _io_bytes()
+    cpu = _cpu_time()
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        wall = time.perf_counter() - start
+        end_read, end_written = _io_bytes()
+        read, written = end_read - read, end_written - written
+        events, peak_rss = _events, _peak_rss()
+        child_peaks = dict()
+        for child in _children:
+            read += child["read_bytes"]
+            written += child["write_bytes"]
+            events += child["events"]
+            child_peaks[child["pid"]] = max(child_peaks.get(child["pid"], 0), child["peak_rss"])
+        del _children[:]
+        stats.update(wall=wall, cpu=_cpu_time() - cpu, peak_rss=peak_rss + sum(child_peaks.values()),
+                     read_bytes=read, write_bytes=written,
+                     events=events, events_per_s=events/wall if wall else 0.)
+
+
+def _size(nbytes):
+    for unit in ["B", "kB", "MB", "GB"]:
+        if abs(nbytes) < 1024:
+            return f'{nbytes:.0f}{unit}' if unit == "B" else f'{nbytes:.1f}{unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f}TB'
+
+
+class Telemetry:
+    """**Measurements of the tasks of a run, summed per stage**
+
+    A stage is the tool (or `cleanup`) a task belongs to. Time, bytes
+    and events are summed over the tasks of a stage, the peak RSS is the
+    largest of its tasks.
+    """
+    sums = ["wall", "cpu", "read_bytes", "write_bytes", "events"]
+
+    def __init__(self):
+        self.tasks = list()
+
+    def add(self, stage, name, stats):
+        self.tasks.append({"stage": stage, "task": name, **stats})
+
+    def stages(self):
+        stages = dict()
+        for task in self.tasks:
+            stage = stages.setdefault(task["stage"], {"tasks": 0, "peak_rss": 0,
+                                                      **{key: 0 for key in self.sums}})
+            stage["tasks"] += 1
+            stage["peak_rss"] = max(stage["peak_rss"], task.get("peak_rss", 0))
+            for key in self.sums:
+                stage[key] += task.get(key, 0)
+        for stage in stages.values():
+            stage["events_per_s"] = stage["events"]/stage["wall"] if stage["wall"] else 0.
+        return stages
+
+    def table(self):
+        header = f'{"Stage":10} {"Tasks":>5} {"Wall":>9} {"CPU":>9} {"Peak RSS":>9} ' \
+                 f'{"Read":>9} {"Written":>9} {"Events":>11} {"Events/s":>10}'
+        lines = [header, "-"*len(header)]
+        for name, stage in self.stages().items():
+            lines.append(f'{name:10} {stage["tasks"]:>5} {stage["wall"]:>8.1f}s {stage["cpu"]:>8.1f}s '
+                         f'{_size(stage["peak_rss"]):>9} {_size(stage["read_bytes"]):>9} '
+                         f'{_size(stage["write_bytes"]):>9} {stage["events"]:>11} '
+                         f'{stage["events_per_s"]:>10.0f}')
+        return "\n".join(lines)
+
+    def report(self, workdir, tool):
+        """**Write the JSON summary and print the table**
+
+        The summary goes to `workdir/telemetry/<tool>_<date>_<time>.json`
+        so earlier runs are kept to compare with.
+
+        Returns:
+          Path: the JSON file
+        """
+        outdir = Path(workdir) / "telemetry"
+        outdir.mkdir(parents=True, exist_ok=True)
+        outfile = outdir / f'{tool}_{time.strftime("%Y%m%d_%H%M%S")}.json'
+        with open(outfile, 'w') as f:
+            json.dump({"tool": tool, "command": " ".join(sys.argv), "time": time.time(),
+                       "stages": self.stages(), "tasks": self.tasks}, f, indent=1)
+        print(self.table())
+        print(f'Telemetry written to {outfile}')
+        return outfile
@@ -1,17 +1,18 @@
 #!/usr/bin/env python3
 from collections import OrderedDict
+import numpy as np
 from analysis_suite.Variable_Creator.vargetter import VarGetter as vg, Variable
 from analysis_suite.Combine.systematics import Systematic
 
-# Variables used in Training
+# Variables used in Training, stored as int32 (counts) or float32 unless given a dtype
 allvar = {
-    "NJets" :           Variable(vg.num, "Jets"),
-    "NBJets":           Variable(vg.num, "BJets"),
-    "NResolvedTops":    Variable(vg.num, "ResolvedTops"),
-    "NlooseBJets":      Variable(vg.var, 'BJets/n_loose'),
-    "NtightBJets":      Variable(vg.var, 'BJets/n_tight'),
-    "NlooseMuons":      Variable(vg.num, 'LooseMuon'),
-    "NlooseElectrons":  Variable(vg.num, 'LooseElectron'),
+    "NJets" :           Variable(vg.num, "Jets", np.int8),
+    "NBJets":           Variable(vg.num, "BJets", np.int8),
+    "NResolvedTops":    Variable(vg.num, "ResolvedTops", np.int8),
+    "NlooseBJets":      Variable(vg.var, 'BJets/n_loose', np.int8),
+    "NtightBJets":      Variable(vg.var, 'BJets/n_tight', np.int8),
+    "NlooseMuons":      Variable(vg.num, 'LooseMuon', np.int8),
+    "NlooseElectrons":  Variable(vg.num, 'LooseElectron', np.int8),
     "HT":               Variable(vg.var, 'HT'),
     "HT_b":             Variable(vg.var, 'HT_b'),
     "Met":              Variable(vg.var, 'Met'),
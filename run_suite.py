@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-import multiprocessing as mp
 import warnings
 import logging
 
 from analysis_suite.commons.configs import get_cli, first_time_actions
+from analysis_suite.commons.scheduler import Scheduler
+from analysis_suite.commons.telemetry import measure
 warnings.filterwarnings('ignore')
 
 if __name__ == "__main__":
@@ -16,7 +17,15 @@ if __name__ == "__main__":
     # Setup jobs #
     ##############
 
-    if cli_args.tool == "mva":
+    if cli_args.tool == "pipeline":
+        from analysis_suite.commons.pipeline import Pipeline
+        failed = Pipeline(cli_args).run(cli_args.j)
+        if failed:
+            logging.error(f'{len(failed)} tasks failed: {", ".join(failed)}\n'
+                          'Fix them and rerun, tasks that are up to date are skipped')
+            exit(1)
+        exit()
+    elif cli_args.tool == "mva":
         from analysis_suite.BDT_utilities import job_main
     elif cli_args.tool == "plot":
         from analysis_suite.Plotting import job_main
@@ -29,15 +38,20 @@ if __name__ == "__main__":
 
 
     argList = job_main.setup(cli_args)
-    func = job_main.run
 
     #############
     # Start Job #
     #############
-    if cli_args.j == 1:
-        [func(*al) for al in argList]
-    else:
-        with mp.Pool(cli_args.j) as pool:
-            pool.starmap(func, argList)
-
-    job_main.cleanup(cli_args)
+    scheduler = Scheduler(job_main, cli_args.tool, cli_args.workdir,
+                          retries=cli_args.retries, resume=cli_args.resume)
+    failed = scheduler.run(argList, cli_args.j)
+    if failed:
+        scheduler.telemetry.report(cli_args.workdir, cli_args.tool)
+        logging.error(f'{len(failed)} tasks failed: {", ".join(failed)}\n'
+                      'Fix them and rerun with --resume to only redo what is missing')
+        exit(1)
+
+    with measure() as stats:
+        job_main.cleanup(cli_args)
+    scheduler.telemetry.add("cleanup", cli_args.tool, stats)
+    scheduler.telemetry.report(cli_args.workdir, cli_args.tool)
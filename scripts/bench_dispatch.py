@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the run_suite pool: worker startup and per task dispatch
+overhead, with the shared config pickled into every task (as before)
+or sent once per worker through the pool initializer (see Scheduler).
+
+    python3 scripts/bench_dispatch.py -j 8 -n 2000 --info plotInfo_default --tool plot
+"""
+import time
+import pickle
+import argparse
+import multiprocessing as mp
+
+from analysis_suite.commons.scheduler import _init_worker, _run_task
+
+tools = {"plot": "analysis_suite.Plotting.job_main",
+         "mva": "analysis_suite.BDT_utilities.job_main",
+         "combine": "analysis_suite.Combine.job_main",
+         "analyze": "analysis_suite.Variable_Creator.job_main"}
+
+shared = dict()
+
+def with_config(key, plot_info, group_info):
+    return len(key)
+
+def with_key(key):
+    return len(key) + len(shared)
+
+def get_config(info):
+    if info is None:
+        # stand in of about the size of a PlotInfo and GroupInfo
+        config = {f'hist{i}': {"Binning": [20, 0, 400], "Label": "x"*20} for i in range(200)}
+        return config, dict(config)
+    from analysis_suite.commons import PlotInfo, GroupInfo
+    return PlotInfo(info), GroupInfo()
+
+def time_tasks(pool, func, argList):
+    tasks = [(idx, func, args) for idx, args in enumerate(argList)]
+    start = time.perf_counter()
+    for _ in pool.imap_unordered(_run_task, tasks, chunksize=1):
+        pass
+    return time.perf_counter() - start
+
+def time_startup(nprocs, module, config):
+    """Seconds until every worker has run its initializer and one task"""
+    start = time.perf_counter()
+    with mp.Pool(nprocs, _init_worker, (module, config)) as pool:
+        pool.map(len, ["x"]*nprocs, chunksize=1)
+        return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the pool used by run_suite")
+    parser.add_argument("-j", type=int, default=mp.cpu_count(), help="Number of processes")
+    parser.add_argument("-n", type=int, default=1000, help="Number of tasks")
+    parser.add_argument("--info", default=None, help="PlotInfo to use as the shared config")
+    parser.add_argument("--tool", choices=list(tools), default=None,
+                        help="Also time the startup of workers preloading this tool")
+    args = parser.parse_args()
+
+    plot_info, group_info = get_config(args.info)
+    config = {"plot_info": plot_info, "group_info": group_info}
+    print(f'Shared config: {len(pickle.dumps(config))/1024:.1f} kB pickled')
+
+    print(f'Startup of {args.j} workers: {time_startup(args.j, "__main__", None):.3f}s')
+    if args.tool is not None:
+        module = tools[args.tool]
+        print(f'Startup of {args.j} workers preloading {args.tool}: '
+              f'{time_startup(args.j, module, None):.3f}s')
+
+    keys = [f'hist{i}' for i in range(args.n)]
+    with mp.Pool(args.j) as pool:
+        seconds = time_tasks(pool, with_config, [(key, plot_info, group_info) for key in keys])
+    print(f'Config in every task: {1e6*seconds/args.n:8.1f} us/task')
+    with mp.Pool(args.j, _init_worker, ("__main__", config)) as pool:
+        seconds = time_tasks(pool, with_key, [(key,) for key in keys])
+    print(f'Config in initializer: {1e6*seconds/args.n:7.1f} us/task')
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Import time of the entry points, from `python -X importtime`, and which
+heavy libraries they load. With --check, exits with an error if
+`--help` of run_suite.py or analyze.py loads any of them, or a tool's
+job_main loads one it does not need. Run from the top of the suite:
+
+    python3 scripts/bench_imports.py --check
+"""
+import sys
+import argparse
+import subprocess
+
+heavy = ["pandas", "ROOT", "uproot", "uproot4", "awkward1", "matplotlib", "mplhep",
+         "xgboost", "keras", "tensorflow", "sklearn", "numba", "scipy", "boost_histogram"]
+
+# name: (command, heavy libraries allowed)
+cases = {
+    "run_suite --help": (["run_suite.py", "--help"], []),
+    "analyze --help": (["analyze.py", "--help"], []),
+    "analyze tool": (["-c", "import analysis_suite.Variable_Creator.job_main"],
+                     ["pandas", "uproot", "uproot4", "awkward1"]),
+    "mva tool": (["-c", "import analysis_suite.BDT_utilities.job_main"],
+                 ["uproot4", "awkward1"]),
+    "plot tool": (["-c", "import analysis_suite.Plotting.job_main"],
+                  ["uproot4", "awkward1", "matplotlib", "mplhep", "scipy", "boost_histogram"]),
+    "combine tool": (["-c", "import analysis_suite.Combine.job_main"],
+                     ["uproot", "uproot4", "awkward1", "scipy", "boost_histogram"]),
+}
+
+def import_times(command):
+    """Cumulative import time (us) of each top level import, and the
+    names of every module imported"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", *command],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = dict()
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules.add(name.strip().split(".")[0])
+        if not name[1:].startswith(" "):
+            times[name.strip()] = int(cumulative)
+    return times, modules
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of the analysis suite entry points")
+    parser.add_argument("--check", action="store_true",
+                        help="Fail if an entry point loads a heavy library it does not need")
+    parser.add_argument("-n", type=int, default=3, help="Runs of each case, best is shown")
+    args = parser.parse_args()
+
+    bad = list()
+    for name, (command, allowed) in cases.items():
+        runs = [import_times(command) for _ in range(args.n)]
+        times, modules = min(runs, key=lambda run: sum(run[0].values()))
+        loaded = [lib for lib in heavy if lib in modules]
+        extra = [lib for lib in loaded if lib not in allowed]
+        print(f'{name:18} {sum(times.values())/1e3:8.1f} ms  heavy: {", ".join(loaded) or "-"}')
+        if extra:
+            bad.append(f'{name} loads {", ".join(extra)}')
+
+    if bad and args.check:
+        print("\n".join(bad))
+        exit(1)
@@ -21,6 +21,7 @@ for year in ${years}; do
     fi
 
     hadd -f result_${year}.root $path_start/${analysis_dir}/*
+    python3 -m analysis_suite.commons.metadata result_${year}.root
 done
 
 # hadd results